@@ -0,0 +1,246 @@
+"""Offline end-to-end benchmark of the bot handlers.
+
+Runs the real handlers from bot.py against an in-memory Mongo and a fake
+Telegram client (see harness.py), so no network, bot token or mongod is
+needed. Reports p50/p99 latency per scenario and updates/sec.
+
+    python benchmarks/bench_handlers.py --size 10000 100000
+    python benchmarks/bench_handlers.py --size 1000000 --scenario search paging
+    python benchmarks/bench_handlers.py --flood-rate 0.05 --latency 0.02
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("GROUP_ID", "-1001234567890")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot  # noqa: E402
+import harness  # noqa: E402
+
+SCENARIOS = ["search", "search_cached", "paging", "filtering", "fuzzy", "indexing"]
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def report(name, samples, elapsed, errors=0):
+    print(
+        f"  {name:<14} n={len(samples):<6} "
+        f"p50={percentile(samples, 50) * 1000:8.2f}ms "
+        f"p99={percentile(samples, 99) * 1000:8.2f}ms "
+        f"mean={statistics.fmean(samples) * 1000 if samples else 0:8.2f}ms "
+        f"{len(samples) / elapsed if elapsed else 0:9.1f} updates/s"
+        + (f"  errors={errors}" if errors else "")
+    )
+
+async def run_updates(name, updates, concurrency):
+    """Run update coroutine factories with bounded concurrency and time each one"""
+    samples = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def run(make_update):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await make_update()
+            except Exception:
+                errors += 1
+            samples.append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(run(update) for update in updates))
+    report(name, samples, time.perf_counter() - started, errors)
+
+def reset_state(client):
+    """Fresh bot globals for each catalog size"""
+    harness.install_memory_store(bot)
+    bot.app = client
+    
+    bot.index_postings.clear()
+    bot.index_doc_tokens.clear()
+    bot.index_file_keys.clear()
+    bot.index_doc_meta.clear()
+    bot.index_sorted_tokens = []
+    bot.index_vocab_dirty = True
+    bot.index_changes.clear()
+    bot.dedup_key_owner.clear()
+    bot.index_doc_keys.clear()
+    bot.dedup_canonical.clear()
+    bot.dedup_groups.clear()
+    bot.duplicate_files.clear()
+    bot.fuzzy_titles.clear()
+    bot.fuzzy_trigrams.clear()
+    bot.result_cache.clear()
+    bot.session_cache.clear()
+    bot.delete_heap.clear()
+    
+    # Admission would otherwise throttle the synthetic users after 3 searches
+    bot.SEARCH_USER_RATE = 1e9
+    bot.SEARCH_USER_BURST = 10 ** 9
+    bot.user_search_buckets.clear()
+    bot.search_cooldowns.clear()
+    bot.group_search_bucket = bot.TokenBucket(1e9, 1e9)
+
+def search_message(client, user_id, text):
+    return harness.FakeMessage(client, bot.GROUP_ID, text, user_id=user_id)
+
+def results_token(client, user_id):
+    """Session token of the last result message DMed to user_id"""
+    message = client.last_sent.get(user_id)
+    if not message or not message.reply_markup:
+        return None
+    for row in message.reply_markup.inline_keyboard:
+        for button in row:
+            parts = (button.callback_data or "").split(":")
+            if len(parts) == 3:
+                return parts[1]
+    return None
+
+def callback(client, user_id, data):
+    return harness.FakeCallbackQuery(client, user_id, data, client.last_sent[user_id])
+
+async def bench_size(size, args):
+    client = harness.FakeClient(latency=args.latency, flood_rate=args.flood_rate, seed=size)
+    reset_state(client)
+    rnd = random.Random(size)
+    
+    filenames = harness.generate_filenames(size, seed=size)
+    started = time.perf_counter()
+    await harness.seed_catalog(bot, filenames)
+    print(f"\ncatalog={size:,} files  seeded in {time.perf_counter() - started:.1f}s  "
+          f"vocabulary={len(bot.index_postings):,} tokens")
+    
+    queries = [" ".join(title.split()[:rnd.randint(1, 3)]) for title in harness.TITLES]
+    users = list(range(1, args.users + 1))
+    count = args.updates
+    
+    if "search" in args.scenario:
+        bot.result_cache.clear()
+        updates = [
+            (lambda u=users[i % len(users)], q=queries[i % len(queries)] + f" {1990 + i % 30}":
+                bot.handle_search(client, search_message(client, u, q)))
+            for i in range(count)
+        ]
+        await run_updates("search", updates, args.concurrency)
+    
+    if "search_cached" in args.scenario:
+        updates = [
+            (lambda u=users[i % len(users)], q=queries[i % 10]:
+                bot.handle_search(client, search_message(client, u, q)))
+            for i in range(count)
+        ]
+        await run_updates("search_cached", updates, args.concurrency)
+    
+    # Every user gets a fresh result message to page and filter on
+    if {"paging", "filtering"} & set(args.scenario):
+        for user_id in users:
+            await bot.handle_search(client, search_message(client, user_id, rnd.choice(queries)))
+        tokens = {user_id: results_token(client, user_id) for user_id in users}
+        users = [user_id for user_id in users if tokens[user_id]]
+    
+    if "paging" in args.scenario and users:
+        updates = [
+            (lambda u=users[i % len(users)], p=i % 5 + 1:
+                bot.handle_callbacks(client, callback(client, u, f"pg:{tokens[u]}:{p}")))
+            for i in range(count)
+        ]
+        await run_updates("paging", updates, args.concurrency)
+    
+    if "filtering" in args.scenario and users:
+        menus = list(bot.FILTER_TYPES)
+        updates = []
+        for i in range(count):
+            user_id = users[i % len(users)]
+            if i % 2:
+                data = f"fm:{tokens[user_id]}:{menus[i % len(menus)]}"
+            else:
+                data = f"fs:{tokens[user_id]}:quality={harness.QUALITIES[i % len(harness.QUALITIES)]}"
+            updates.append(lambda u=user_id, d=data: bot.handle_callbacks(client, callback(client, u, d)))
+        await run_updates("filtering", updates, args.concurrency)
+        
+        # Filters stack per session; clear them so later runs start clean
+        for user_id in users:
+            await bot.handle_callbacks(client, callback(client, user_id, f"fc:{tokens[user_id]}:0"))
+    
+    if "fuzzy" in args.scenario:
+        bot.result_cache.clear()
+        typos = []
+        for title in harness.TITLES:
+            word = title.split()[0].lower()
+            if len(word) > 3:
+                i = rnd.randrange(1, len(word) - 1)
+                typos.append(word[:i] + word[i + 1:] + "x")
+        updates = [
+            (lambda u=users[i % len(users)] if users else 1, q=typos[i % len(typos)]:
+                bot.handle_search(client, search_message(client, u, q)))
+            for i in range(count)
+        ]
+        await run_updates("fuzzy", updates, args.concurrency)
+    
+    if "indexing" in args.scenario:
+        await bench_indexing(client, min(size, args.index_messages))
+    
+    calls = ", ".join(f"{name}={value}" for name, value in sorted(client.calls.items()))
+    print(f"  telegram calls: {calls}")
+
+async def bench_indexing(client, count):
+    """Index a fresh channel through index_channel, timing each batch flush"""
+    channel_id = -1002
+    client.history[channel_id] = harness.make_channel_messages(
+        client, channel_id, harness.generate_filenames(count, seed=count + 1)
+    )
+    
+    samples = []
+    flush_index_batch = bot.flush_index_batch
+    
+    async def timed_flush(records):
+        started = time.perf_counter()
+        await flush_index_batch(records)
+        if records:
+            samples.append(time.perf_counter() - started)
+    
+    bot.flush_index_batch = timed_flush
+    try:
+        started = time.perf_counter()
+        scanned, indexed, _ = await bot.index_channel(channel_id)
+        elapsed = time.perf_counter() - started
+    finally:
+        bot.flush_index_batch = flush_index_batch
+    
+    report("index_batch", samples, elapsed)
+    print(f"  {'indexing':<14} {scanned:,} messages, {indexed:,} files in {elapsed:.2f}s "
+          f"({scanned / elapsed if elapsed else 0:,.0f} messages/s)")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, nargs="+", default=[10_000, 100_000],
+                        help="catalog sizes to seed (1000000 takes a few minutes)")
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--updates", type=int, default=500, help="updates per scenario")
+    parser.add_argument("--users", type=int, default=50, help="distinct synthetic users")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="updates in flight at once (pyrogram runs up to `workers`)")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Telegram API latency (s)")
+    parser.add_argument("--flood-rate", type=float, default=0.0,
+                        help="share of Telegram calls that raise FloodWait")
+    parser.add_argument("--index-messages", type=int, default=20_000,
+                        help="channel messages for the indexing scenario")
+    args = parser.parse_args()
+    
+    for size in args.size:
+        await bench_size(size, args)
+
+if __name__ == "__main__":
+    # Same loop pyrogram registered the handlers on at import time
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,45 @@
+"""Micro-benchmark for parse_file_info over real-world release names.
+
+Usage:
+    python benchmarks/bench_parse_file_info.py [count]
+
+Repeats benchmarks/release_names.txt up to ``count`` names (default 200000)
+and reports names/sec for the single-name and batch APIs.
+"""
+import os
+import random
+import sys
+import time
+
+# bot.py reads its config at import time
+os.environ.setdefault("API_ID", "1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bot import parse_file_info, parse_file_infos
+
+CORPUS = os.path.join(os.path.dirname(__file__), "release_names.txt")
+
+def load_corpus(count):
+    with open(CORPUS, encoding="utf-8") as f:
+        names = [line.strip() for line in f if line.strip()]
+    corpus = (names * (count // len(names) + 1))[:count]
+    random.Random(0).shuffle(corpus)
+    return corpus
+
+def bench(label, func, corpus, sizes):
+    started = time.perf_counter()
+    func(corpus, sizes)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<24} {len(corpus) / elapsed:>12,.0f} names/s  ({elapsed * 1000:.1f} ms)")
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    corpus = load_corpus(count)
+    sizes = [random.Random(i).randint(200, 8000) * 1024 ** 2 for i in range(len(corpus))]
+    
+    print(f"parse_file_info over {len(corpus):,} release names")
+    bench("parse_file_info", lambda names, sizes: [parse_file_info(name, size) for name, size in zip(names, sizes)], corpus, sizes)
+    bench("parse_file_infos", parse_file_infos, corpus, sizes)
+
+if __name__ == "__main__":
+    main()
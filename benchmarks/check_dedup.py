@@ -0,0 +1,77 @@
+"""Regression checks for duplicate grouping in the search index.
+
+Usage:
+    python benchmarks/check_dedup.py
+
+Indexes copies of the same release through flush_index_batch against the
+in-memory store (see harness.py) and asserts which copy stays searchable
+after re-indexing, renaming and removal.
+"""
+import asyncio
+import os
+import sys
+
+# bot.py reads its config at import time
+os.environ.setdefault("API_ID", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot  # noqa: E402
+import harness  # noqa: E402
+
+RELEASE = "Movie.Name.2020.1080p.mkv"
+
+def reset():
+    harness.install_memory_store(bot)
+    bot.app = harness.FakeClient()
+    for state in (
+        bot.index_postings, bot.index_doc_tokens, bot.index_file_keys, bot.index_doc_meta,
+        bot.fuzzy_titles, bot.fuzzy_trigrams, bot.dedup_key_owner, bot.index_doc_keys,
+        bot.dedup_canonical, bot.dedup_groups, bot.duplicate_files, bot.result_cache
+    ):
+        state.clear()
+    bot.index_sorted_tokens = []
+    bot.index_vocab_dirty = True
+    bot.index_changes.clear()
+
+async def post(channel_id, file_name, file_id=1, file_size=100):
+    await bot.flush_index_batch([
+        {"file_name": file_name, "file_size": file_size, "file_id": file_id, "channel_id": channel_id}
+    ])
+    return bot.index_file_keys[(channel_id, file_id)]
+
+async def check_reindex_keeps_canonical():
+    reset()
+    first = await post(-1, RELEASE)
+    second = await post(-2, RELEASE)
+    await post(-1, RELEASE)
+    assert bot.search_index_lookup("movie name") == [first]
+    assert bot.dedup_groups[first] == {second}
+
+async def check_removal_promotes_duplicate():
+    reset()
+    await post(-1, RELEASE)
+    second = await post(-2, RELEASE)
+    await bot.remove_channel_files(-1, [1])
+    assert bot.search_index_lookup("movie name") == [second]
+    assert not bot.dedup_groups and not bot.duplicate_files
+
+async def check_rename_releases_group():
+    reset()
+    first = await post(-1, RELEASE)
+    second = await post(-2, RELEASE)
+    await post(-1, "Totally.Different.2021.mkv")
+    assert bot.search_index_lookup("movie name") == [second]
+    assert bot.search_index_lookup("totally different") == [first]
+    assert not bot.dedup_groups and not bot.duplicate_files
+
+CHECKS = [check_reindex_keeps_canonical, check_removal_promotes_duplicate, check_rename_releases_group]
+
+async def main():
+    for check in CHECKS:
+        await check()
+        print(f"ok  {check.__name__}")
+
+if __name__ == "__main__":
+    # Same loop pyrogram registered the handlers on at import time
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,543 @@
+"""Offline stand-ins for Mongo and Telegram used by the handler benchmarks.
+
+MemoryCollection implements the subset of the motor collection API that
+bot.py uses, on plain dicts, with hash indexes on _id and on declared
+equality keys so large catalogs stay fast. FakeClient records every
+Telegram call and can raise FloodWait on a share of sends.
+"""
+import asyncio
+import itertools
+import random
+import types
+from collections import defaultdict
+from copy import deepcopy
+
+from bson import ObjectId
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from pyrogram.errors import FloodWait
+
+# ==================== MEMORY STORE ====================
+def get_field(doc, path):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None, False
+        value = value[part]
+    return value, True
+
+def compare(value, op, operand):
+    if op == "$in":
+        return any(match_value(value, item) for item in operand)
+    if op == "$nin":
+        return not any(match_value(value, item) for item in operand)
+    if op == "$ne":
+        return not match_value(value, operand)
+    if op == "$eq":
+        return match_value(value, operand)
+    if value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        if op == "$lte":
+            return value <= operand
+    except TypeError:
+        return False
+    raise NotImplementedError(op)
+
+def match_value(value, expected):
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value == expected
+
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+            continue
+        if key == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+            continue
+        
+        value, present = get_field(doc, key)
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            for op, operand in condition.items():
+                if op == "$exists":
+                    if present != bool(operand):
+                        return False
+                elif not compare(value, op, operand):
+                    return False
+        elif not match_value(value, condition):
+            return False
+    return True
+
+def project(doc, projection):
+    if not projection:
+        return deepcopy(doc)
+    include = {k for k, v in projection.items() if v}
+    if include:
+        out = {k: deepcopy(doc[k]) for k in include if k in doc}
+        if projection.get("_id", 1):
+            out["_id"] = doc["_id"]
+        return out
+    return {k: deepcopy(v) for k, v in doc.items() if k not in projection}
+
+def apply_update(doc, update, inserting):
+    for op, fields in update.items():
+        for key, value in fields.items():
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                doc[key] = deepcopy(value)
+            elif op == "$unset":
+                doc.pop(key, None)
+            elif op == "$inc":
+                doc[key] = doc.get(key, 0) + value
+            elif op == "$max":
+                doc[key] = value if doc.get(key) is None else max(doc[key], value)
+            elif op == "$min":
+                doc[key] = value if doc.get(key) is None else min(doc[key], value)
+            elif op == "$addToSet":
+                items = doc.setdefault(key, [])
+                if value not in items:
+                    items.append(value)
+            elif op != "$setOnInsert":
+                raise NotImplementedError(op)
+
+class Result(types.SimpleNamespace):
+    pass
+
+class MemoryCursor:
+    def __init__(self, docs, projection=None):
+        self._docs = docs
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+    
+    def sort(self, key, direction=1):
+        self._sort = [(key, direction)] if isinstance(key, str) else list(key)
+        return self
+    
+    def skip(self, count):
+        self._skip = count
+        return self
+    
+    def limit(self, count):
+        self._limit = count
+        return self
+    
+    def _results(self):
+        docs = list(self._docs)
+        for key, direction in reversed(self._sort or []):
+            docs.sort(key=lambda d: (d.get(key) is None, d.get(key)), reverse=direction < 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [project(doc, self._projection) for doc in docs]
+    
+    async def to_list(self, length=None):
+        docs = self._results()
+        return docs[:length] if length else docs
+    
+    def __aiter__(self):
+        self._iter = iter(self._results())
+        return self
+    
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+    
+    async def explain(self):
+        return {"queryPlanner": {"winningPlan": {"stage": "IXSCAN"}}}
+
+class MemoryCollection:
+    """Async, motor-shaped collection over a dict of documents"""
+    
+    def __init__(self, name, keys=()):
+        self.name = name
+        self.docs = {}
+        # Hash indexes: field tuple -> {values: {_id}}; unique when declared as such
+        self.keys = [tuple(k) for k in keys]
+        self.key_index = {key: defaultdict(set) for key in self.keys}
+    
+    # ---- index helpers ----
+    def _key_values(self, key, doc):
+        return tuple(doc.get(field) for field in key)
+    
+    def _add(self, doc):
+        self.docs[doc["_id"]] = doc
+        for key in self.keys:
+            self.key_index[key][self._key_values(key, doc)].add(doc["_id"])
+    
+    def _remove(self, doc):
+        self.docs.pop(doc["_id"], None)
+        for key in self.keys:
+            ids = self.key_index[key].get(self._key_values(key, doc))
+            if ids:
+                ids.discard(doc["_id"])
+    
+    def _candidates(self, query):
+        condition = query.get("_id")
+        if condition is not None:
+            if isinstance(condition, dict) and "$in" in condition:
+                return [self.docs[i] for i in dict.fromkeys(condition["$in"]) if i in self.docs]
+            if not isinstance(condition, dict):
+                return [self.docs[condition]] if condition in self.docs else []
+        
+        for key in self.keys:
+            values = []
+            for field in key:
+                condition = query.get(field)
+                if condition is None:
+                    break
+                if isinstance(condition, dict):
+                    if set(condition) != {"$in"}:
+                        break
+                    values.append(condition["$in"])
+                else:
+                    values.append([condition])
+            else:
+                ids = set()
+                for combo in itertools.product(*values):
+                    ids |= self.key_index[key].get(combo, set())
+                return [self.docs[i] for i in ids]
+        
+        return list(self.docs.values())
+    
+    def _find(self, query):
+        query = query or {}
+        return [doc for doc in self._candidates(query) if matches(doc, query)]
+    
+    # ---- motor API ----
+    def find(self, query=None, projection=None, **kwargs):
+        return MemoryCursor(self._find(query), projection)
+    
+    async def find_one(self, query=None, projection=None, **kwargs):
+        docs = self._find(query)
+        return project(docs[0], projection) if docs else None
+    
+    async def count_documents(self, query):
+        return len(self._find(query))
+    
+    async def estimated_document_count(self):
+        return len(self.docs)
+    
+    async def distinct(self, field, query=None):
+        values = []
+        for doc in self._find(query):
+            value, present = get_field(doc, field)
+            if present:
+                for item in value if isinstance(value, list) else [value]:
+                    if item not in values:
+                        values.append(item)
+        return values
+    
+    async def insert_one(self, doc):
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError("duplicate _id")
+        self._add(deepcopy(doc))
+        return Result(inserted_id=doc["_id"])
+    
+    async def insert_many(self, docs, ordered=True):
+        ids = []
+        for doc in docs:
+            ids.append((await self.insert_one(doc)).inserted_id)
+        return Result(inserted_ids=ids)
+    
+    def _upsert_doc(self, query, update):
+        doc = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+        doc["_id"] = doc.get("_id", ObjectId())
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError("duplicate _id")
+        apply_update(doc, update, inserting=True)
+        self._add(doc)
+        return doc
+    
+    def _update(self, query, update, upsert=False, many=False):
+        docs = self._find(query)
+        if not many:
+            docs = docs[:1]
+        for doc in docs:
+            self._remove(doc)
+            apply_update(doc, update, inserting=False)
+            self._add(doc)
+        upserted_id = None
+        if not docs and upsert:
+            upserted_id = self._upsert_doc(query, update)["_id"]
+        return Result(matched_count=len(docs), modified_count=len(docs), upserted_id=upserted_id)
+    
+    async def update_one(self, query, update, upsert=False, **kwargs):
+        return self._update(query, update, upsert)
+    
+    async def update_many(self, query, update, upsert=False, **kwargs):
+        return self._update(query, update, upsert, many=True)
+    
+    async def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=False, sort=None, **kwargs):
+        docs = self._find(query)
+        if sort:
+            docs = MemoryCursor(docs).sort(sort)._results()
+            docs = [self.docs[d["_id"]] for d in docs]
+        if not docs:
+            if not upsert:
+                return None
+            doc = self._upsert_doc(query, update)
+            return project(doc, projection) if return_document else None
+        
+        doc = docs[0]
+        before = project(doc, projection)
+        self._remove(doc)
+        apply_update(doc, update, inserting=False)
+        self._add(doc)
+        return project(doc, projection) if return_document else before
+    
+    async def bulk_write(self, ops, ordered=True):
+        upserted_ids = {}
+        for i, op in enumerate(ops):
+            if not isinstance(op, (UpdateOne, UpdateMany)):
+                raise NotImplementedError(type(op).__name__)
+            result = self._update(op._filter, op._doc, upsert=op._upsert, many=isinstance(op, UpdateMany))
+            if result.upserted_id is not None:
+                upserted_ids[i] = result.upserted_id
+        return Result(upserted_ids=upserted_ids)
+    
+    async def delete_one(self, query):
+        docs = self._find(query)[:1]
+        for doc in docs:
+            self._remove(doc)
+        return Result(deleted_count=len(docs))
+    
+    async def delete_many(self, query):
+        docs = self._find(query)
+        for doc in docs:
+            self._remove(doc)
+        return Result(deleted_count=len(docs))
+    
+    async def create_indexes(self, models):
+        return [model.document["name"] for model in models]
+    
+    async def create_index(self, *args, **kwargs):
+        return "index"
+    
+    def watch(self, *args, **kwargs):
+        raise RuntimeError("change streams are not available in the memory store")
+
+class MemoryAdmin:
+    async def command(self, name, *args, **kwargs):
+        return {"ok": 1}
+
+class MemoryMongoClient:
+    admin = MemoryAdmin()
+
+# Equality keys the bot looks documents up by
+COLLECTION_KEYS = {
+    "files": [("file_id", "channel_id")],
+    "users": [("user_id",)],
+    "channels": [("channel_id",)],
+    "broadcast_deliveries": [("job_id", "user_id")],
+}
+
+def install_memory_store(bot):
+    """Point every *_collection / queue global of bot at a fresh memory store"""
+    collections = {}
+    for attr in dir(bot):
+        value = getattr(bot, attr)
+        # A second install finds the memory collections the first one left behind
+        if type(value).__name__ == "AsyncIOMotorCollection" or isinstance(value, MemoryCollection):
+            name = value.name
+            if name not in collections:
+                collections[name] = MemoryCollection(name, COLLECTION_KEYS.get(name, ()))
+            setattr(bot, attr, collections[name])
+    bot.mongo_client = MemoryMongoClient()
+    
+    # REQUIRED_INDEXES / CANONICAL_QUERIES captured the real collections at import
+    if hasattr(bot, "REQUIRED_INDEXES"):
+        bot.REQUIRED_INDEXES = [(collections[c.name], models) for c, models in bot.REQUIRED_INDEXES]
+    if hasattr(bot, "CANONICAL_QUERIES"):
+        bot.CANONICAL_QUERIES = [(collections[c.name], q, s) for c, q, s in bot.CANONICAL_QUERIES]
+    return collections
+
+# ==================== FAKE TELEGRAM ====================
+message_ids = itertools.count(1000)
+
+class FakeMessage:
+    """Just enough of pyrogram.types.Message for the bot handlers"""
+    
+    def __init__(self, client, chat_id, text="", user_id=None, **extra):
+        self._client = client
+        self.id = next(message_ids)
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.from_user = types.SimpleNamespace(id=user_id) if user_id is not None else None
+        self.text = text
+        self.command = text.split() if text.startswith("/") else None
+        self.entities = None
+        self.reply_to_message = None
+        self.reply_markup = None
+        self.document = None
+        self.video = None
+        self.caption = None
+        self.__dict__.update(extra)
+    
+    async def reply(self, text, **kwargs):
+        return await self._client.send_message(self.chat.id, text, **kwargs)
+    
+    async def edit(self, text, **kwargs):
+        await self._client.record("edit_message_text", self.chat.id)
+        self.text = text
+        self.reply_markup = kwargs.get("reply_markup", self.reply_markup)
+        return self
+    
+    async def delete(self):
+        await self._client.delete_messages(self.chat.id, [self.id])
+
+class FakeCallbackQuery:
+    def __init__(self, client, user_id, data, message):
+        self._client = client
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = message
+        self.id = str(next(message_ids))
+    
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        await self._client.record("answer_callback_query", self.from_user.id)
+        return True
+
+class FakeClient:
+    """Records Telegram calls, optionally adds latency and raises FloodWait"""
+    
+    def __init__(self, latency=0.0, flood_rate=0.0, flood_seconds=1, seed=0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.random = random.Random(seed)
+        self.calls = defaultdict(int)
+        self.sent = {}       # (chat_id, message_id) -> FakeMessage
+        self.last_sent = {}  # chat_id -> last FakeMessage sent there
+        self.history = {}    # channel_id -> [FakeMessage], newest first
+        self.is_connected = True
+    
+    async def record(self, method, chat_id=None):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self.calls["flood_wait"] += 1
+            raise FloodWait(value=self.flood_seconds)
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.record("send_message", chat_id)
+        message = FakeMessage(self, chat_id, text)
+        message.reply_markup = kwargs.get("reply_markup")
+        self.sent[(chat_id, message.id)] = message
+        self.last_sent[chat_id] = message
+        return message
+    
+    async def send_cached_media(self, chat_id, file_id, **kwargs):
+        await self.record("send_cached_media", chat_id)
+        return FakeMessage(self, chat_id, kwargs.get("caption") or "")
+    
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self.record("copy_message", chat_id)
+        return FakeMessage(self, chat_id)
+    
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self.record("edit_message_text", chat_id)
+        message = self.sent.get((chat_id, message_id))
+        if message:
+            message.text = text
+        return message
+    
+    async def delete_messages(self, chat_id, message_ids):
+        await self.record("delete_messages", chat_id)
+        return len(message_ids) if isinstance(message_ids, list) else 1
+    
+    async def get_me(self):
+        await self.record("get_me")
+        return types.SimpleNamespace(id=1, username="BenchBot")
+    
+    async def get_chat_history(self, chat_id, limit=0, offset_id=0, **kwargs):
+        for message in self.history.get(chat_id, []):
+            if offset_id and message.id >= offset_id:
+                continue
+            await self.record("get_chat_history", chat_id)
+            yield message
+
+# ==================== SYNTHETIC CATALOG ====================
+TITLES = [
+    "Avengers Endgame", "Avengers Infinity War", "Mirzapur", "Pushpa The Rise", "Pushpa 2 The Rule",
+    "Vikram", "KGF Chapter 2", "Kantara", "Drishyam 2", "Premam", "Jawan", "Pathaan", "Animal",
+    "RRR", "Breaking Bad", "Game of Thrones", "The Office US", "Stranger Things", "Money Heist",
+    "Sacred Games", "Panchayat", "The Family Man", "Farzi", "Oppenheimer", "Dune Part Two",
+    "Interstellar", "Inception", "The Dark Knight", "Titanic", "Sholay", "Baahubali The Beginning",
+    "Baahubali 2 The Conclusion", "Leo", "Jailer", "Salaar", "Manjummel Boys", "Aavesham",
+    "12th Fail", "Laapataa Ladies", "Scam 1992", "Kota Factory", "Heeramandi", "The Boys",
+    "House of the Dragon", "Shogun", "One Piece", "Naruto Shippuden", "Spider-Man Across the Spider-Verse",
+    "Top Gun Maverick", "Joker",
+]
+QUALITIES = ["480p", "720p", "1080p", "2160p"]
+LANGUAGE_SETS = [["Hindi"], ["English"], ["Tamil"], ["Telugu"], ["Hindi", "English"], ["Malayalam"], ["Kannada"], []]
+SOURCES = ["WEB-DL", "WEBRip", "BluRay", "HDRip", "HDTV", "NF.WEB-DL", "AMZN.WEB-DL"]
+CODECS = ["x264", "x265", "HEVC", "H.264", "AV1"]
+SEPARATORS = [".", " ", "_"]
+
+def generate_filenames(count, seed=0):
+    """Realistic release names: title, year or SxxEyy, quality, language, source, codec"""
+    rnd = random.Random(seed)
+    names = []
+    for i in range(count):
+        title = rnd.choice(TITLES)
+        # Suffixes make the catalog grow beyond the title list
+        if rnd.random() < 0.3:
+            title += f" Part {rnd.randint(1, 5)}"
+        parts = title.split()
+        if rnd.random() < 0.4:
+            parts.append(f"S{rnd.randint(1, 8):02d}E{rnd.randint(1, 24):02d}")
+        else:
+            parts.append(str(rnd.randint(1960, 2025)))
+        parts.append(rnd.choice(QUALITIES))
+        parts.extend(rnd.choice(LANGUAGE_SETS))
+        parts.append(rnd.choice(SOURCES))
+        parts.append(rnd.choice(CODECS))
+        names.append(rnd.choice(SEPARATORS).join(parts) + rnd.choice([".mkv", ".mp4"]))
+    return names
+
+def make_channel_messages(client, channel_id, filenames, seed=0):
+    """Channel history for get_chat_history, newest first"""
+    rnd = random.Random(seed)
+    messages = []
+    for i, name in enumerate(filenames):
+        message = FakeMessage(client, channel_id, id=i + 1)
+        message.id = i + 1
+        message.document = types.SimpleNamespace(
+            file_name=name,
+            file_size=rnd.randint(200, 8000) * 1024 ** 2,
+            file_id=f"BQAC{i:08d}",
+            file_unique_id=f"AgAD{i:08d}"
+        )
+        messages.append(message)
+    messages.reverse()
+    return messages
+
+async def seed_catalog(bot, filenames, channel_id=-1001):
+    """Insert a catalog straight through the bot's own batch writer"""
+    batch_size = bot.INDEX_BATCH_SIZE
+    rnd = random.Random(1)
+    for start in range(0, len(filenames), batch_size):
+        records = [
+            {
+                "file_name": name,
+                "file_size": rnd.randint(200, 8000) * 1024 ** 2,
+                "file_id": start + i + 1,
+                "channel_id": channel_id
+            }
+            for i, name in enumerate(filenames[start:start + batch_size])
+        ]
+        await bot.flush_index_batch(records)
@@ -1,10 +1,24 @@
 import os
 import asyncio
+import heapq
 import re
+import secrets
+import signal
+import socket
+import time
+import zlib
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict
 from datetime import datetime, timedelta
-from pyrogram import Client, filters, enums
+from functools import wraps
+from pyrogram import Client, StopPropagation, filters, enums
+from pyrogram.errors import FloodWait, InputUserDeactivated, PeerIdInvalid, UserIsBlocked
+from pyrogram.session import Session
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from rapidfuzz import fuzz, process
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiohttp import web
@@ -22,6 +36,33 @@ MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017")
 ADMIN_IDS = [int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x]
 GROUP_ID = int(os.environ.get("GROUP_ID", "-1001234567890"))
 PORT = int(os.environ.get("PORT", 8080))
+RESULTS_PER_PAGE = 10
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 300))
+RESULT_CACHE_MAX_ROWS = int(os.environ.get("RESULT_CACHE_MAX_ROWS", 200000))
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 3600))
+INDEX_BATCH_SIZE = int(os.environ.get("INDEX_BATCH_SIZE", 500))
+INDEX_PROGRESS_INTERVAL = 30
+INDEX_FLUSH_INTERVAL = float(os.environ.get("INDEX_FLUSH_INTERVAL", 2))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 20))
+BROADCAST_PROGRESS_INTERVAL = 15
+SEARCH_USER_RATE = float(os.environ.get("SEARCH_USER_RATE", 0.2))     # searches/sec per user
+SEARCH_USER_BURST = int(os.environ.get("SEARCH_USER_BURST", 3))
+SEARCH_COOLDOWN = int(os.environ.get("SEARCH_COOLDOWN", 30))
+SEARCH_GROUP_RATE = float(os.environ.get("SEARCH_GROUP_RATE", 10))    # searches/sec for the whole group
+# Splitting updates across replicas relies on change streams to share bans and files
+MULTI_REPLICA = os.environ.get("MULTI_REPLICA", "").lower() in ("1", "true", "yes")
+REPLICA_ID = os.environ.get("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = int(os.environ.get("LEASE_TTL", 30))
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", 2))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 5))
+DELIVERY_CONCURRENCY = int(os.environ.get("DELIVERY_CONCURRENCY", 10))
+DELIVERY_QUEUE_SIZE = int(os.environ.get("DELIVERY_QUEUE_SIZE", 1000))
+SEARCH_LOG_FLUSH_INTERVAL = float(os.environ.get("SEARCH_LOG_FLUSH_INTERVAL", 5))
+SEARCH_LOG_RETENTION_DAYS = int(os.environ.get("SEARCH_LOG_RETENTION_DAYS", 30))
+WARM_TOP_QUERIES = int(os.environ.get("WARM_TOP_QUERIES", 50))
+WARM_INTERVAL = int(os.environ.get("WARM_INTERVAL", RESULT_CACHE_TTL))   # re-warm before warmed entries expire
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 25))   # Render kills the process 30s after SIGTERM
 
 # ==================== DATABASE ====================
 mongo_client = AsyncIOMotorClient(MONGO_URI)
@@ -30,9 +71,126 @@ files_collection = db.files
 users_collection = db.users
 channels_collection = db.channels
 delete_queue = db.delete_queue
+broadcasts_collection = db.broadcasts
+broadcast_deliveries = db.broadcast_deliveries
+sessions_collection = db.search_sessions
+leases_collection = db.leases
+jobs_collection = db.jobs
+search_log = db.search_log
+
+# ==================== METRICS ====================
+# Minimal Prometheus text-format metrics, served on /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRIC_HELP = {
+    "bot_operation_seconds": ("histogram", "Latency of bot operations"),
+    "telegram_api_seconds": ("histogram", "Latency of Telegram API calls by method"),
+    "telegram_flood_wait_seconds_total": ("counter", "FloodWait seconds Telegram made us wait, by method"),
+    "telegram_api_errors_total": ("counter", "Failed Telegram API calls by method"),
+    "bot_updates_total": ("counter", "Updates received by type"),
+    "files_delivered_total": ("counter", "File deliveries to users by outcome"),
+}
+
+metric_counters = defaultdict(float)   # (name, labels) -> value
+metric_histograms = {}                 # (name, labels) -> [bucket counts..., sum, count]
+
+def metric_labels(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    metric_counters[(name, metric_labels(labels))] += value
+
+def observe(name, seconds, **labels):
+    key = (name, metric_labels(labels))
+    hist = metric_histograms.get(key)
+    if hist is None:
+        hist = metric_histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if seconds <= bound:
+            hist[i] += 1
+    hist[-2] += seconds
+    hist[-1] += 1
+
+def timed(op):
+    """Record the latency of an async function in bot_operation_seconds"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                observe("bot_operation_seconds", time.perf_counter() - started, op=op)
+        return wrapper
+    return decorator
+
+def format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+def render_metrics(gauges, counters=()):
+    """Render every metric plus the given point-in-time gauges and externally kept counters"""
+    lines = []
+    described = set()
+    
+    def describe(name, kind, help_text):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+    
+    for (name, labels), value in sorted(metric_counters.items()):
+        describe(name, *METRIC_HELP.get(name, ("counter", name)))
+        lines.append(f"{name}{format_labels(labels)} {value:g}")
+    
+    for (name, labels), hist in sorted(metric_histograms.items()):
+        describe(name, *METRIC_HELP.get(name, ("histogram", name)))
+        for bound, count in zip(LATENCY_BUCKETS, hist):
+            lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {count}")
+        lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {hist[-1]}")
+        lines.append(f"{name}_sum{format_labels(labels)} {hist[-2]:.6f}")
+        lines.append(f"{name}_count{format_labels(labels)} {hist[-1]}")
+    
+    for kind, samples in (("counter", counters), ("gauge", gauges)):
+        for name, help_text, value in samples:
+            describe(name, kind, help_text)
+            lines.append(f"{name} {value:g}")
+    
+    return "\n".join(lines) + "\n"
+
+class InstrumentedClient(Client):
+    """Pyrogram client that times every raw API call and counts FloodWait sleeps"""
+    
+    async def invoke(self, query, retries=Session.MAX_RETRIES, timeout=Session.WAIT_TIMEOUT, sleep_threshold=None):
+        method = type(query).__name__
+        if sleep_threshold is None:
+            sleep_threshold = self.sleep_threshold
+        
+        # The session would sleep off short FloodWaits where we can't see them,
+        # so it raises every one and the waits under the threshold happen here
+        while True:
+            started = time.perf_counter()
+            try:
+                return await super().invoke(query, retries, timeout, sleep_threshold=0)
+            except FloodWait as e:
+                wait = e.value
+                inc("telegram_flood_wait_seconds_total", wait, method=method)
+                if wait > sleep_threshold:
+                    inc("telegram_api_errors_total", method=method)
+                    raise
+            except Exception:
+                inc("telegram_api_errors_total", method=method)
+                raise
+            finally:
+                observe("telegram_api_seconds", time.perf_counter() - started, method=method)
+            
+            logger.warning(f"FloodWait on {method}: sleeping {wait}s")
+            await asyncio.sleep(wait)
 
 # ==================== PYROGRAM CLIENT ====================
-app = Client(
+app = InstrumentedClient(
     "file_bot",
     api_id=API_ID,
     api_hash=API_HASH,
@@ -43,10 +201,571 @@ app = Client(
 
 scheduler = AsyncIOScheduler()
 
+# ==================== SEARCH INDEX ====================
+# In-memory inverted index over file names. Mongo stays the source of truth,
+# the index only maps normalized tokens to document _ids.
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+index_postings = defaultdict(set)   # token -> {_id}
+index_doc_tokens = {}               # _id -> tuple of tokens in the file name
+index_file_keys = {}                # (channel_id, file_id) -> _id
+index_sorted_tokens = []            # sorted vocabulary for prefix lookups
+index_vocab_dirty = False
+index_changes = []                  # token tuples of files added or removed since the last invalidate_results()
+INDEX_CHANGES_LIMIT = 5000          # past this, invalidate_results() empties the whole result cache
+
+# Column store of filterable metadata, so filters and facet counts need no query
+FACET_FIELDS = ("quality", "year", "language", "season")
+index_doc_meta = {}                 # _id -> (quality, year, languages, season)
+
+# Fuzzy suggestions work on distinct normalized titles, prefiltered by trigrams
+FUZZY_CANDIDATES = 500
+fuzzy_titles = {}                   # title -> [display name, number of files]
+fuzzy_trigrams = defaultdict(set)   # trigram -> {title}
+
+# Dedup: files with the same Telegram file_unique_id, or the same normalized
+# name and size, form a group. Only the canonical (first indexed) file of a
+# group is searchable; the others are kept aside for reporting and promotion.
+FINGERPRINT_NOISE = re.compile(r"(@\w+|https?://\S+|www\.\S+|t\.me/\S+)", re.IGNORECASE)
+VIDEO_EXTENSIONS = {"mkv", "mp4", "avi", "m4v", "mov", "webm", "ts"}
+
+dedup_key_owner = {}                # hashed dedup key -> canonical _id
+index_doc_keys = {}                 # _id -> hashed dedup keys of a canonical file
+dedup_canonical = {}                # duplicate _id -> canonical _id
+dedup_groups = defaultdict(set)     # canonical _id -> {duplicate _id}
+duplicate_files = {}                # duplicate _id -> (channel_id, file_id, file_name, info)
+DEDUP_INFO_FIELDS = FACET_FIELDS + ("file_size", "file_unique_id", "fingerprint")
+
+def file_fingerprint(file_name, file_size):
+    """Normalized name plus size; survives renamed extensions, channel tags and separators"""
+    tokens = tokenize(FINGERPRINT_NOISE.sub(" ", file_name or ""))
+    if tokens and tokens[-1] in VIDEO_EXTENSIONS:
+        tokens.pop()
+    return f"{' '.join(tokens)}:{file_size or 0}"
+
+def dedup_keys(file_name, info):
+    keys = [hash("f:" + (info.get("fingerprint") or file_fingerprint(file_name, info.get("file_size"))))]
+    if info.get("file_unique_id"):
+        keys.append(hash("u:" + info["file_unique_id"]))
+    return tuple(keys)
+
+def tokenize(text):
+    """Split text into lowercased word tokens"""
+    return TOKEN_PATTERN.findall(text.casefold())
+
+def trigrams(text):
+    """Return the set of character trigrams of a padded string"""
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def add_fuzzy_title(title, file_name):
+    entry = fuzzy_titles.get(title)
+    if entry:
+        entry[1] += 1
+        return
+    
+    fuzzy_titles[title] = [file_name, 1]
+    for gram in trigrams(title):
+        fuzzy_trigrams[gram].add(title)
+
+def remove_fuzzy_title(title):
+    entry = fuzzy_titles.get(title)
+    if not entry:
+        return
+    
+    entry[1] -= 1
+    if entry[1] > 0:
+        return
+    
+    del fuzzy_titles[title]
+    for gram in trigrams(title):
+        titles = fuzzy_trigrams.get(gram)
+        if titles is not None:
+            titles.discard(title)
+            if not titles:
+                del fuzzy_trigrams[gram]
+
+def note_index_change(tokens):
+    if len(index_changes) <= INDEX_CHANGES_LIMIT:
+        index_changes.append(tokens)
+
+def index_file(doc_id, channel_id, file_id, file_name, info=None):
+    """Add or refresh a file in the search index"""
+    global index_vocab_dirty
+    
+    info = info or {}
+    keys = dedup_keys(file_name, info)
+    
+    # A duplicate regroups from scratch, and so does a canonical file whose new
+    # name or media no longer matches every member of its group
+    if doc_id in dedup_canonical or (doc_id in index_doc_tokens and not all(
+        set(keys) & set(dedup_keys(*duplicate_files[member][2:])) for member in dedup_groups.get(doc_id, ())
+    )):
+        unindex_file(doc_id)
+    
+    index_file_keys[(channel_id, file_id)] = doc_id
+    
+    if doc_id in index_doc_tokens:
+        # Refreshing a canonical file keeps it canonical, along with its group
+        remove_postings(doc_id)
+        for key in index_doc_keys.get(doc_id, ()):
+            if key not in keys and dedup_key_owner.get(key) == doc_id:
+                del dedup_key_owner[key]
+    else:
+        # Duplicates join the group of the first file sharing a key
+        canonical = next((dedup_key_owner[key] for key in keys if key in dedup_key_owner), None)
+        if canonical is not None:
+            dedup_canonical[doc_id] = canonical
+            dedup_groups[canonical].add(doc_id)
+            duplicate_files[doc_id] = (
+                channel_id, file_id, file_name,
+                {field: info.get(field) for field in DEDUP_INFO_FIELDS}
+            )
+            return
+    for key in keys:
+        dedup_key_owner.setdefault(key, doc_id)
+    index_doc_keys[doc_id] = keys
+    
+    tokens = tuple(tokenize(file_name or ""))
+    index_doc_tokens[doc_id] = tokens
+    index_doc_meta[doc_id] = (
+        info.get("quality"),
+        info.get("year"),
+        tuple(info.get("language") or ()),
+        info.get("season")
+    )
+    if tokens:
+        add_fuzzy_title(fuzzy_title(tokens), file_name)
+    note_index_change(tokens)
+    
+    for token in set(tokens):
+        if token not in index_postings:
+            index_vocab_dirty = True
+        index_postings[token].add(doc_id)
+
+def is_indexed(doc_id, channel_id, file_id, file_name, info=None):
+    """Whether a file is already in the search index with this exact data"""
+    info = info or {}
+    if index_file_keys.get((channel_id, file_id)) != doc_id:
+        return False
+    if doc_id in dedup_canonical:
+        return duplicate_files.get(doc_id) == (
+            channel_id, file_id, file_name,
+            {field: info.get(field) for field in DEDUP_INFO_FIELDS}
+        )
+    return (
+        index_doc_tokens.get(doc_id) == tuple(tokenize(file_name or ""))
+        and index_doc_keys.get(doc_id) == dedup_keys(file_name, info)
+        and index_doc_meta.get(doc_id) == (
+            info.get("quality"),
+            info.get("year"),
+            tuple(info.get("language") or ()),
+            info.get("season")
+        )
+    )
+
+def remove_postings(doc_id):
+    """Drop a canonical file's tokens, metadata and fuzzy title"""
+    global index_vocab_dirty
+    
+    tokens = index_doc_tokens.pop(doc_id, ())
+    index_doc_meta.pop(doc_id, None)
+    if tokens:
+        remove_fuzzy_title(fuzzy_title(tokens))
+        note_index_change(tokens)
+    
+    for token in set(tokens):
+        postings = index_postings.get(token)
+        if postings is None:
+            continue
+        postings.discard(doc_id)
+        if not postings:
+            del index_postings[token]
+            index_vocab_dirty = True
+
+def unindex_file(doc_id):
+    """Remove a file from the search index, promoting its oldest duplicate"""
+    canonical = dedup_canonical.pop(doc_id, None)
+    if canonical is not None:
+        dedup_groups[canonical].discard(doc_id)
+        if not dedup_groups[canonical]:
+            del dedup_groups[canonical]
+        duplicate_files.pop(doc_id, None)
+        return
+    
+    for key in index_doc_keys.pop(doc_id, ()):
+        if dedup_key_owner.get(key) == doc_id:
+            del dedup_key_owner[key]
+    remove_postings(doc_id)
+    
+    # Promote the oldest duplicate; the rest regroup under it
+    members = dedup_groups.pop(doc_id, ())
+    for member in sorted(members):
+        dedup_canonical.pop(member, None)
+        channel_id, file_id, file_name, info = duplicate_files.pop(member)
+        index_file(member, channel_id, file_id, file_name, info)
+
+def expand_prefix(prefix):
+    """Return every indexed token starting with prefix"""
+    global index_sorted_tokens, index_vocab_dirty
+    
+    if index_vocab_dirty:
+        index_sorted_tokens = sorted(index_postings)
+        index_vocab_dirty = False
+    
+    matches = []
+    i = bisect_left(index_sorted_tokens, prefix)
+    while i < len(index_sorted_tokens) and index_sorted_tokens[i].startswith(prefix):
+        matches.append(index_sorted_tokens[i])
+        i += 1
+    return matches
+
+def search_index_lookup(query):
+    """Return _ids of files matching every query token, best matches first"""
+    query_tokens = list(dict.fromkeys(tokenize(query)))
+    if not query_tokens:
+        return []
+    
+    # Rarest token first keeps the running intersection small
+    scores = None
+    for token in sorted(query_tokens, key=lambda t: len(index_postings.get(t, ()))):
+        token_scores = {}
+        for doc_id in index_postings.get(token, ()):
+            token_scores[doc_id] = 2
+        for match in expand_prefix(token):
+            if match == token:
+                continue
+            for doc_id in index_postings[match]:
+                token_scores.setdefault(doc_id, 1)
+        
+        if scores is None:
+            scores = token_scores
+        else:
+            scores = {doc_id: score + token_scores[doc_id] for doc_id, score in scores.items() if doc_id in token_scores}
+        if not scores:
+            return []
+    
+    # Exact token hits beat prefix hits, shorter names beat longer ones
+    return sorted(scores, key=lambda doc_id: (-scores[doc_id], len(index_doc_tokens[doc_id])))
+
+def filter_doc_ids(doc_ids, filters):
+    """Keep the _ids whose metadata matches every active filter"""
+    active = [(FACET_FIELDS.index(field), value) for field, value in (filters or {}).items() if value]
+    if not active:
+        return doc_ids
+    
+    def matches(doc_id):
+        meta = index_doc_meta.get(doc_id)
+        if meta is None:
+            return False
+        for pos, value in active:
+            # language is the only multi-valued column
+            if pos == 2:
+                if value not in meta[2]:
+                    return False
+            elif meta[pos] != value:
+                return False
+        return True
+    
+    return [doc_id for doc_id in doc_ids if matches(doc_id)]
+
+def facet_counts(doc_ids, field):
+    """Count the values of one metadata field over a set of _ids"""
+    pos = FACET_FIELDS.index(field)
+    counts = Counter()
+    for doc_id in doc_ids:
+        meta = index_doc_meta.get(doc_id)
+        if meta is None:
+            continue
+        if pos == 2:
+            counts.update(meta[2])
+        elif meta[pos] is not None:
+            counts[meta[pos]] += 1
+    return counts
+
+async def build_search_index():
+    """Rebuild the search index from the files collection"""
+    index_postings.clear()
+    index_doc_tokens.clear()
+    index_file_keys.clear()
+    index_doc_meta.clear()
+    fuzzy_titles.clear()
+    fuzzy_trigrams.clear()
+    dedup_key_owner.clear()
+    index_doc_keys.clear()
+    dedup_canonical.clear()
+    dedup_groups.clear()
+    duplicate_files.clear()
+    
+    count = 0
+    # Oldest first, so the first copy of a release stays canonical across restarts
+    cursor = files_collection.find(
+        {},
+        {"file_name": 1, "file_id": 1, "channel_id": 1, **{field: 1 for field in DEDUP_INFO_FIELDS}}
+    ).sort("_id", ASCENDING)
+    async for doc in cursor:
+        index_file(doc["_id"], doc.get("channel_id"), doc.get("file_id"), doc.get("file_name"), doc)
+        count += 1
+    invalidate_results()
+    
+    logger.info(
+        f"🔎 Search index built: {count} files ({len(duplicate_files)} duplicates), "
+        f"{len(index_postings)} tokens"
+    )
+
+# ==================== RESULT CACHE ====================
+class TTLCache:
+    """LRU cache with per-entry expiry and an optional total weight bound"""
+    
+    def __init__(self, maxsize, ttl, max_weight=None, weigh=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()   # key -> (expires_at, weight, value)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[0] < time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return default
+        
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+    
+    def set(self, key, value):
+        self.pop(key)
+        weight = self.weigh(value) if self.max_weight else 0
+        self._data[key] = (time.monotonic() + self.ttl, weight, value)
+        self.weight += weight
+        
+        while self._data and (
+            len(self._data) > self.maxsize
+            or (self.max_weight and self.weight > self.max_weight)
+        ):
+            _, (_, old_weight, _) = self._data.popitem(last=False)
+            self.weight -= old_weight
+    
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self.weight -= entry[1]
+        return entry[2]
+    
+    def keys(self):
+        return list(self._data)
+    
+    def clear(self):
+        self._data.clear()
+        self.weight = 0
+
+# Result sets are cached as ranked _ids only, plus the facet counts computed
+# for them so far; page documents are fetched when a page is rendered
+result_cache = TTLCache(
+    RESULT_CACHE_SIZE,
+    RESULT_CACHE_TTL,
+    max_weight=RESULT_CACHE_MAX_ROWS,
+    weigh=lambda entry: len(entry["ids"])
+)
+
+def result_cache_key(query, filters=None):
+    """Cache key for a query: normalized tokens plus the active filters"""
+    active = tuple(sorted((k, v) for k, v in (filters or {}).items() if v))
+    return (" ".join(tokenize(query)), active)
+
+def invalidate_results():
+    """Drop cached result sets that a file added or removed since the last call could belong to"""
+    if len(index_changes) > INDEX_CHANGES_LIMIT:
+        result_cache.clear()
+    elif index_changes:
+        # A query matches a file when each query token is a prefix of one of its tokens
+        changed = [{token[:i] for token in tokens for i in range(1, len(token) + 1)} for tokens in index_changes]
+        for key in result_cache.keys():
+            query_tokens = key[0].split()
+            if any(all(token in prefixes for token in query_tokens) for prefixes in changed):
+                result_cache.pop(key)
+    index_changes.clear()
+
+inflight_calls = {}   # key -> future shared by concurrent identical calls
+
+async def single_flight(key, factory):
+    """Run factory() once for every concurrent caller using the same key"""
+    future = inflight_calls.get(key)
+    if future is None:
+        future = asyncio.ensure_future(factory())
+        inflight_calls[key] = future
+        future.add_done_callback(lambda _: inflight_calls.pop(key, None))
+    # One caller giving up must not cancel the search for the others
+    return await asyncio.shield(future)
+
+# ==================== RATE LIMITING ====================
+TELEGRAM_GLOBAL_RATE = 25   # bots get roughly 30 messages/sec overall
+TELEGRAM_CHAT_RATE = 1      # and about one message/sec per chat
+
+class TokenBucket:
+    """Token bucket allowing rate operations per second with bursts up to capacity"""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+    
+    def try_acquire(self):
+        """Take a token if one is available, without waiting"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    def penalize(self, seconds):
+        """Stall every caller for roughly seconds (used on FloodWait)"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+global_send_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE)
+chat_send_buckets = TTLCache(10000, 60)   # chat_id -> TokenBucket
+
+async def acquire_send_slot(chat_id):
+    """Wait for both the per-chat and the global send limit"""
+    bucket = chat_send_buckets.get(chat_id)
+    if bucket is None:
+        bucket = TokenBucket(TELEGRAM_CHAT_RATE)
+        chat_send_buckets.set(chat_id, bucket)
+    
+    await bucket.acquire()
+    await global_send_bucket.acquire()
+
+# ==================== SEARCH SESSIONS ====================
+# Each result message gets a short opaque token; callbacks carry "op:token:arg"
+# and the query, filters and suggestions are looked up server-side.
+FILTER_TYPES = {"quality": str, "year": int, "language": str, "season": int}
+
+session_cache = TTLCache(10000, SESSION_TTL)
+
+async def create_session(query, suggestions=None):
+    """Store a new search session and return it"""
+    session = {
+        "_id": secrets.token_urlsafe(6),
+        "query": query,
+        "filters": {},
+        "suggestions": suggestions or [],
+        "expires_at": datetime.utcnow() + timedelta(seconds=SESSION_TTL)
+    }
+    await sessions_collection.insert_one(session)
+    session_cache.set(session["_id"], session)
+    return session
+
+async def get_session(token):
+    session = session_cache.get(token)
+    if session is None:
+        session = await sessions_collection.find_one({"_id": token})
+        if session:
+            session_cache.set(token, session)
+    return session
+
+async def save_session(session):
+    await sessions_collection.update_one(
+        {"_id": session["_id"]},
+        {"$set": {"query": session["query"], "filters": session["filters"]}}
+    )
+    session_cache.set(session["_id"], session)
+
+# ==================== USER REGISTRY ====================
+# Users are upserted write-behind: handlers merge field changes into
+# pending_user_writes and a loop flushes them with one bulk_write. "reachable"
+# records whether the bot can DM the user (set by /start and by every DM
+# attempt) and is cached so handlers can skip sends that would fail.
+USER_FLUSH_INTERVAL = 10
+USER_FLUSH_BATCH_SIZE = 500
+
+pending_user_writes = {}                     # user_id -> fields to $set
+reachable_cache = TTLCache(100000, 6 * 3600)  # user_id -> True/False
+
+def record_user(user_id, **fields):
+    """Queue an upsert of a user; the newest value of each field wins"""
+    update = pending_user_writes.setdefault(user_id, {})
+    update.update(fields)
+    update["last_seen"] = datetime.utcnow()
+    if "reachable" in fields:
+        reachable_cache.set(user_id, fields["reachable"])
+    
+    if len(pending_user_writes) >= USER_FLUSH_BATCH_SIZE:
+        track_flush(flush_user_writes())
+
+async def flush_user_writes():
+    if not pending_user_writes:
+        return
+    
+    batch = dict(pending_user_writes)
+    pending_user_writes.clear()
+    try:
+        await users_collection.bulk_write([
+            UpdateOne(
+                {"user_id": user_id},
+                {"$set": fields, "$setOnInsert": {"first_seen": fields["last_seen"]}},
+                upsert=True
+            )
+            for user_id, fields in batch.items()
+        ], ordered=False)
+    except Exception as e:
+        logger.error(f"User registry flush error: {e}")
+        # Newer writes queued meanwhile take precedence
+        for user_id, fields in batch.items():
+            pending_user_writes[user_id] = {**fields, **pending_user_writes.get(user_id, {})}
+
+async def user_registry_loop():
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        await flush_user_writes()
+
+async def is_reachable(user_id):
+    """Cached DM reachability: True, False, or None when the bot never tried"""
+    reachable = reachable_cache.get(user_id)
+    if reachable is None:
+        pending = pending_user_writes.get(user_id, {})
+        if "reachable" in pending:
+            return pending["reachable"]
+        
+        user = await users_collection.find_one({"user_id": user_id}, {"reachable": 1})
+        reachable = (user or {}).get("reachable")
+        if reachable is not None:
+            reachable_cache.set(user_id, reachable)
+    return reachable
+
 # ==================== HELPER FUNCTIONS ====================
-async def is_banned(user_id):
-    user = await users_collection.find_one({"user_id": user_id})
-    return user and user.get("banned", False)
+banned_users = set()   # mirror of users with banned=True, checked on every update
+
+def is_banned(user_id):
+    return user_id in banned_users
 
 async def ban_user(user_id):
     await users_collection.update_one(
@@ -54,6 +773,7 @@ async def ban_user(user_id):
         {"$set": {"banned": True}},
         upsert=True
     )
+    banned_users.add(user_id)
 
 async def unban_user(user_id):
     await users_collection.update_one(
@@ -61,39 +781,162 @@ async def unban_user(user_id):
         {"$set": {"banned": False}},
         upsert=True
     )
+    banned_users.discard(user_id)
+
+async def load_banned_users():
+    """Load all banned user ids into memory"""
+    banned_users.clear()
+    banned_users.update(await users_collection.distinct("user_id", {"banned": True}))
+    logger.info(f"🚫 Loaded {len(banned_users)} banned users")
+
+async def change_streams_available():
+    """Change streams need a replica set or a sharded cluster"""
+    hello = await mongo_client.admin.command("hello")
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
 
-def parse_file_info(filename):
-    """Extract quality, year, language, season from filename"""
+async def follow_changes(collection, pipeline, apply):
+    """Feed change stream events to apply(); in multi-replica mode reopen after errors where it left off"""
+    resume_token = None
+    while True:
+        try:
+            async with collection.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                async for change in stream:
+                    apply(change)
+                    resume_token = stream.resume_token
+            return
+        except Exception as e:
+            if not MULTI_REPLICA:
+                # Change streams need a replica set; a single instance does without
+                logger.warning(f"{collection.name} change stream unavailable: {e}")
+                return
+            logger.error(f"{collection.name} change stream failed, reopening: {e}")
+            await asyncio.sleep(5)
+
+def apply_ban_change(change):
+    user = change.get("fullDocument")
+    if not user:
+        return
+    if user.get("banned"):
+        banned_users.add(user["user_id"])
+    else:
+        banned_users.discard(user["user_id"])
+
+async def watch_bans():
+    """Follow ban changes made by other replicas through a change stream"""
+    pipeline = [{"$match": {"$or": [
+        {"operationType": {"$in": ["insert", "replace"]}, "fullDocument.banned": {"$exists": True}},
+        {"operationType": "update", "updateDescription.updatedFields.banned": {"$exists": True}}
+    ]}}]
+    await follow_changes(users_collection, pipeline, apply_ban_change)
+
+# Metadata patterns are compiled once; parse_file_info runs for every indexed message
+LANGUAGES = ["Hindi", "English", "Tamil", "Telugu", "Kannada", "Malayalam"]
+
+# Patterns run on the lowercased name, which is cheaper than re.IGNORECASE
+QUALITY_PATTERN = re.compile(r"(480p|720p|1080p|2160p|4k)")
+YEAR_PATTERN = re.compile(r"(19\d{2}|20\d{2})")
+LANGUAGE_PATTERN = re.compile("|".join(lang.lower() for lang in LANGUAGES))
+SEASON_PATTERN = re.compile(r"s(\d{1,2})")
+EPISODE_PATTERN = re.compile(r"s\d{1,2}[ ._-]?e(\d{1,4})")
+CODEC_PATTERN = re.compile(r"(x26[45]|h[ .]?26[45]|(?<![a-z])(?:hevc|avc|av1))(?![a-z0-9])")
+SOURCE_PATTERN = re.compile(
+    r"(?<![a-z0-9])(web[ .-]?dl|web[ .-]?rip|blu[ .-]?ray|bd[ .-]?rip|br[ .-]?rip|hd[ .-]?rip|dvd[ .-]?rip|hdtv|hd[ .-]?cam|cam[ .-]?rip|pre[ .-]?dvd)(?![a-z0-9])"
+)
+SEPARATORS = re.compile(r"[ .-]")
+
+# Whole tokens parse_file_info reads as metadata rather than title
+TITLE_NOISE = re.compile(
+    r"480p|720p|1080p|2160p|4k|19\d{2}|20\d{2}|s\d{1,2}(?:e\d{1,4})?|e\d{1,4}|"
+    + "|".join(lang.lower() for lang in LANGUAGES) + "|" + "|".join(VIDEO_EXTENSIONS)
+)
+
+def fuzzy_title(tokens):
+    """Title part of a tokenized name: year, quality, codec, source and the like removed"""
+    text = SOURCE_PATTERN.sub(" ", CODEC_PATTERN.sub(" ", " ".join(tokens)))
+    title = [token for token in text.split() if not TITLE_NOISE.fullmatch(token)]
+    # Names made only of metadata ("2012.mkv") keep their full tokens
+    return " ".join(title or tokens)
+
+CODEC_NAMES = {
+    "x264": "x264", "h264": "x264", "avc": "x264",
+    "x265": "x265", "h265": "x265", "hevc": "x265",
+    "av1": "AV1"
+}
+SOURCE_NAMES = {
+    "webdl": "WEB-DL", "webrip": "WEBRip", "bluray": "BluRay", "bdrip": "BluRay",
+    "brrip": "BluRay", "hdrip": "HDRip", "dvdrip": "DVDRip", "hdtv": "HDTV",
+    "hdcam": "CAM", "camrip": "CAM", "predvd": "CAM"
+}
+SIZE_BUCKETS = [
+    (500 * 1024 ** 2, "<500MB"),
+    (1024 ** 3, "500MB-1GB"),
+    (2 * 1024 ** 3, "1-2GB"),
+    (4 * 1024 ** 3, "2-4GB"),
+]
+
+def size_bucket(size):
+    """Coarse size class used for filtering"""
+    for limit, label in SIZE_BUCKETS:
+        if size < limit:
+            return label
+    return "4GB+"
+
+def parse_file_info(filename, file_size=None):
+    """Extract quality, year, language, season, episode, codec and source from filename"""
     info = {
         "quality": None,
         "year": None,
         "language": [],
-        "season": None
+        "season": None,
+        "episode": None,
+        "codec": None,
+        "source": None
     }
     
+    lower = filename.lower()
+    
     # Quality
-    quality_match = re.search(r'(480p|720p|1080p|2160p|4k)', filename, re.IGNORECASE)
+    quality_match = QUALITY_PATTERN.search(lower)
     if quality_match:
         info["quality"] = quality_match.group(1).upper()
     
     # Year
-    year_match = re.search(r'(19\d{2}|20\d{2})', filename)
+    year_match = YEAR_PATTERN.search(lower)
     if year_match:
         info["year"] = int(year_match.group(1))
     
-    # Language
-    languages = ["Hindi", "English", "Tamil", "Telugu", "Kannada", "Malayalam"]
-    for lang in languages:
-        if lang.lower() in filename.lower():
-            info["language"].append(lang)
+    # Language, in LANGUAGES order
+    found = set(LANGUAGE_PATTERN.findall(lower))
+    if found:
+        info["language"] = [lang for lang in LANGUAGES if lang.lower() in found]
     
-    # Season
-    season_match = re.search(r'S(\d{1,2})', filename, re.IGNORECASE)
+    # Season and episode
+    season_match = SEASON_PATTERN.search(lower)
     if season_match:
         info["season"] = int(season_match.group(1))
+        episode_match = EPISODE_PATTERN.search(lower, season_match.start())
+        if episode_match:
+            info["episode"] = int(episode_match.group(1))
+    
+    # Codec and source
+    codec_match = CODEC_PATTERN.search(lower)
+    if codec_match:
+        info["codec"] = CODEC_NAMES[SEPARATORS.sub("", codec_match.group(1))]
+    source_match = SOURCE_PATTERN.search(lower)
+    if source_match:
+        info["source"] = SOURCE_NAMES[SEPARATORS.sub("", source_match.group(1))]
+    
+    if file_size is not None:
+        info["size_bucket"] = size_bucket(file_size)
     
     return info
 
+def parse_file_infos(filenames, file_sizes=None):
+    """Batch version of parse_file_info for a list of filenames"""
+    if file_sizes is None:
+        return [parse_file_info(filename) for filename in filenames]
+    return [parse_file_info(filename, file_size) for filename, file_size in zip(filenames, file_sizes)]
+
 def format_size(size):
     """Convert bytes to readable format"""
     for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
@@ -102,151 +945,1264 @@ def format_size(size):
         size /= 1024.0
     return f"{size:.1f}PB"
 
+@timed("fuzzy_search")
 async def fuzzy_search(query, limit=5):
-    """Find similar file names if exact match not found"""
-    all_files = await files_collection.find().to_list(length=1000)
-    file_names = [f["file_name"] for f in all_files]
+    """Find similar titles if exact match not found; returns (title, example file name) pairs"""
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    title = fuzzy_title(tokens)
+    
+    def rank():
+        # Only titles sharing the most trigrams with the query get scored. Each
+        # update() copies one trigram set in C, so index writes on the loop
+        # cannot change a set mid-iteration.
+        shared = Counter()
+        for gram in trigrams(title):
+            shared.update(fuzzy_trigrams.get(gram, ()))
+        candidates = [candidate for candidate, _ in shared.most_common(FUZZY_CANDIDATES)]
+        return process.extract(title, candidates, scorer=fuzz.token_sort_ratio, limit=limit)
     
-    matches = process.extract(query, file_names, scorer=fuzz.token_sort_ratio, limit=limit)
-    suggestions = [match[0] for match in matches if match[1] > 60]
+    matches = await asyncio.to_thread(rank)
+    suggestions = [
+        (match[0], fuzzy_titles[match[0]][0])
+        for match in matches if match[1] > 60 and match[0] in fuzzy_titles
+    ]
     
     return suggestions
 
+@timed("search_files")
 async def search_files(query, filters=None):
-    """Search files with optional filters"""
-    search_query = {"file_name": {"$regex": query, "$options": "i"}}
-    
-    if filters:
-        if filters.get("quality"):
-            search_query["quality"] = filters["quality"]
-        if filters.get("year"):
-            search_query["year"] = filters["year"]
-        if filters.get("language"):
-            search_query["language"] = {"$in": [filters["language"]]}
-        if filters.get("season"):
-            search_query["season"] = filters["season"]
-    
-    files = await files_collection.find(search_query).to_list(length=None)
-    return files
-
-def create_result_keyboard(page, total_pages, current_filters=None, query=""):
-    """Create pagination and filter keyboard"""
+    """Return (count, ranked _ids) for a query; documents are fetched a page at a time"""
+    doc_ids = filter_doc_ids(search_index_lookup(query), filters)
+    return len(doc_ids), doc_ids
+
+async def stream_page(doc_ids, page):
+    """Yield (_id, file_name, file_size) for one page of ranked _ids, in rank order"""
+    page_ids = get_results_page(doc_ids, page)
+    if not page_ids:
+        return
+    
+    cursor = files_collection.find({"_id": {"$in": page_ids}}, {"file_name": 1, "file_size": 1})
+    
+    # Mongo returns $in matches in storage order; hold back documents that arrive ahead of their rank
+    pending = {}
+    next_rank = 0
+    async for doc in cursor:
+        pending[doc["_id"]] = doc
+        while next_rank < len(page_ids) and page_ids[next_rank] in pending:
+            doc = pending.pop(page_ids[next_rank])
+            next_rank += 1
+            yield doc["_id"], doc["file_name"], doc.get("file_size", 0)
+    
+    # Files deleted since the search was cached leave gaps
+    for doc_id in page_ids[next_rank:]:
+        if doc_id in pending:
+            doc = pending.pop(doc_id)
+            yield doc["_id"], doc["file_name"], doc.get("file_size", 0)
+
+async def get_search_results(query, filters=None):
+    """Return the cached result entry for a query: {"count": n, "ids": [ranked _ids], "facets": {}}"""
+    key = result_cache_key(query, filters)
+    entry = result_cache.get(key)
+    if entry is None:
+        entry = await single_flight(("results", key), lambda: load_search_results(key, query, filters))
+    return entry
+
+async def load_search_results(key, query, filters):
+    count, doc_ids = await search_files(query, filters)
+    entry = {"count": count, "ids": doc_ids, "facets": {}}
+    result_cache.set(key, entry)
+    return entry
+
+def get_facet(entry, query, filters, field):
+    """Counts for one filter menu, cached on the result entry"""
+    counts = entry["facets"].get(field)
+    if counts is None:
+        # Count against every other active filter so the menu can switch values
+        other_filters = {k: v for k, v in (filters or {}).items() if k != field}
+        counts = facet_counts(filter_doc_ids(search_index_lookup(query), other_filters), field)
+        entry["facets"][field] = counts
+    return counts
+
+def get_results_page(results, page):
+    """Slice one page out of a result set"""
+    start = (page - 1) * RESULTS_PER_PAGE
+    return results[start:start + RESULTS_PER_PAGE]
+
+async def render_results(session, entry, page):
+    """Build the text and keyboard for one page of a session's results"""
+    total_results = entry["count"]
+    total_pages = max(1, (total_results + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE)
+    page = min(max(page, 1), total_pages)
+    
+    lines = [f"📁 **Results for \"{session['query']}\"** - {total_results} files found"]
+    if session["filters"]:
+        lines.append("🎯 " + " | ".join(f"{k.title()}: {v}" for k, v in session["filters"].items()))
+    lines.append("")
+    
+    files = []
+    async for doc_id, file_name, file_size in stream_page(entry["ids"], page):
+        lines.append(f"[{format_size(file_size)}] {file_name}\n")
+        files.append((doc_id, file_name, file_size))
+    if files:
+        lines.append("📥 Tap a file below to get it in DM.")
+    
+    keyboard = create_result_keyboard(session["_id"], page, total_pages, session["filters"], files)
+    return "\n".join(lines), keyboard
+
+def create_result_keyboard(token, page, total_pages, current_filters=None, files=()):
+    """Create per-file, filter and pagination keyboard"""
     keyboard = []
+    current_filters = current_filters or {}
     
-    # Filter buttons
+    # One download button per file on the page
+    for doc_id, file_name, file_size in files:
+        keyboard.append([InlineKeyboardButton(
+            f"📥 [{format_size(file_size)}] {file_name[:40]}",
+            callback_data=f"gf:{token}:{doc_id}"
+        )])
+    
+    def filter_label(filter_type, label):
+        value = current_filters.get(filter_type)
+        return f"{label}: {value}" if value else label
+    
+    # Filter buttons carry the page so the menu's Back button returns to it
     filter_row1 = [
-        InlineKeyboardButton("🎨 Quality 🍿", callback_data=f"filter_quality_{query}_{page}"),
-        InlineKeyboardButton("📅 Year 🎬", callback_data=f"filter_year_{query}_{page}")
+        InlineKeyboardButton(filter_label("quality", "🎨 Quality 🍿"), callback_data=f"fm:{token}:quality.{page}"),
+        InlineKeyboardButton(filter_label("year", "📅 Year 🎬"), callback_data=f"fm:{token}:year.{page}")
     ]
     filter_row2 = [
-        InlineKeyboardButton("🔤 Language", callback_data=f"filter_language_{query}_{page}"),
-        InlineKeyboardButton("📺 Season", callback_data=f"filter_season_{query}_{page}")
+        InlineKeyboardButton(filter_label("language", "🔤 Language"), callback_data=f"fm:{token}:language.{page}"),
+        InlineKeyboardButton(filter_label("season", "📺 Season"), callback_data=f"fm:{token}:season.{page}")
     ]
     
     keyboard.append(filter_row1)
     keyboard.append(filter_row2)
+    if current_filters:
+        keyboard.append([InlineKeyboardButton("❌ Clear filters", callback_data=f"fc:{token}:")])
     
     # Pagination buttons
     nav_buttons = []
     if page > 1:
-        nav_buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=f"page_{query}_{page-1}"))
+        nav_buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=f"pg:{token}:{page-1}"))
     
-    nav_buttons.append(InlineKeyboardButton(f"📄 {page}/{total_pages}", callback_data="current_page"))
+    nav_buttons.append(InlineKeyboardButton(f"📄 {page}/{total_pages}", callback_data="noop::"))
     
     if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f"page_{query}_{page+1}"))
+        nav_buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f"pg:{token}:{page+1}"))
     
     keyboard.append(nav_buttons)
     
     return InlineKeyboardMarkup(keyboard)
 
-def create_filter_keyboard(filter_type, query, page):
-    """Create filter selection keyboard"""
+def create_filter_keyboard(filter_type, token, page, counts):
+    """Create filter selection keyboard from facet counts, skipping empty options"""
     keyboard = []
     
     if filter_type == "quality":
-        options = [
-            ("480p", "480P"),
-            ("720p", "720P"),
-            ("1080p", "1080P"),
-            ("4K", "2160P")
-        ]
-        for i in range(0, len(options), 2):
-            row = []
-            for j in range(2):
-                if i + j < len(options):
-                    label, value = options[i + j]
-                    row.append(InlineKeyboardButton(label, callback_data=f"setfilter_quality_{value}_{query}_{page}"))
-            keyboard.append(row)
-    
+        order = {"480P": 0, "720P": 1, "1080P": 2, "2160P": 3, "4K": 4}
+        options = sorted(counts, key=lambda value: order.get(value, len(order)))
+        per_row = 2
+        label = lambda value: value.lower() if value.endswith("P") else value
     elif filter_type == "language":
-        options = ["English", "Hindi", "Tamil", "Telugu", "Kannada", "Malayalam"]
-        for i in range(0, len(options), 2):
-            row = []
-            for j in range(2):
-                if i + j < len(options):
-                    lang = options[i + j]
-                    row.append(InlineKeyboardButton(lang, callback_data=f"setfilter_language_{lang}_{query}_{page}"))
-            keyboard.append(row)
-    
+        options = sorted(counts, key=lambda value: -counts[value])
+        per_row = 2
+        label = str
     elif filter_type == "year":
-        current_year = 2025
-        years = list(range(current_year, 1899, -1))
-        # Show 8 years at a time
-        for i in range(0, 8, 4):
-            row = []
-            for j in range(4):
-                if i + j < 8:
-                    year = years[i + j]
-                    row.append(InlineKeyboardButton(str(year), callback_data=f"setfilter_year_{year}_{query}_{page}"))
-            keyboard.append(row)
-    
-    elif filter_type == "season":
-        seasons = list(range(1, 16))
-        for i in range(0, len(seasons), 5):
-            row = []
-            for j in range(5):
-                if i + j < len(seasons):
-                    season = seasons[i + j]
-                    row.append(InlineKeyboardButton(f"S{season}", callback_data=f"setfilter_season_{season}_{query}_{page}"))
-            keyboard.append(row)
-    
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data=f"back_to_results_{query}_{page}")])
+        # Most recent years first
+        options = sorted(counts, reverse=True)[:12]
+        per_row = 4
+        label = str
+    else:
+        options = sorted(counts)[:20]
+        per_row = 5
+        label = lambda value: f"S{value}"
+    
+    for i in range(0, len(options), per_row):
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{label(value)} ({counts[value]})",
+                callback_data=f"fs:{token}:{filter_type}={value}"
+            )
+            for value in options[i:i + per_row]
+        ])
+    
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data=f"bk:{token}:{page}")])
     
     return InlineKeyboardMarkup(keyboard)
 
+# ==================== DELETE SCHEDULER ====================
+DELETE_BATCH_SIZE = 100          # Telegram accepts up to 100 ids per delete_messages
+DELETE_RETENTION = 24 * 60 * 60  # TTL index drops rows nobody processed within a day
+DELETE_POLL_INTERVAL = 15        # how often the leader picks up rows scheduled by other replicas
+
+delete_heap = []                 # (delete_time, chat_id, message_id, _id)
+delete_wakeup = asyncio.Event()
+
 async def schedule_delete(chat_id, message_id, delay_minutes=15):
     """Schedule message deletion after delay"""
     delete_time = datetime.utcnow() + timedelta(minutes=delay_minutes)
-    await delete_queue.insert_one({
+    result = await delete_queue.insert_one({
         "chat_id": chat_id,
         "message_id": message_id,
         "delete_time": delete_time
     })
+    
+    # Only the leader runs the scheduler; it polls rows scheduled elsewhere
+    if not is_leader:
+        return
+    
+    entry = (delete_time, chat_id, message_id, result.inserted_id)
+    heapq.heappush(delete_heap, entry)
+    if delete_heap[0] is entry:
+        delete_wakeup.set()
+
+async def load_delete_queue():
+    """Load pending deletions from Mongo into the deadline heap"""
+    delete_heap.clear()
+    async for row in delete_queue.find({}, {"chat_id": 1, "message_id": 1, "delete_time": 1}):
+        delete_heap.append((row["delete_time"], row["chat_id"], row["message_id"], row["_id"]))
+    heapq.heapify(delete_heap)
+    delete_wakeup.set()
+    logger.info(f"🗑 Loaded {len(delete_heap)} pending deletions")
+
+async def poll_delete_queue():
+    """Add rows other replicas scheduled for the next poll window to the heap"""
+    known = {row[3] for row in delete_heap}
+    horizon = datetime.utcnow() + timedelta(seconds=DELETE_POLL_INTERVAL)
+    cursor = delete_queue.find(
+        {"delete_time": {"$lte": horizon}},
+        {"chat_id": 1, "message_id": 1, "delete_time": 1}
+    )
+    async for row in cursor:
+        if row["_id"] not in known:
+            heapq.heappush(delete_heap, (row["delete_time"], row["chat_id"], row["message_id"], row["_id"]))
 
+async def delete_message_batch(chat_id, message_ids):
+    """Delete up to DELETE_BATCH_SIZE messages of one chat, waiting out FloodWait"""
+    while True:
+        try:
+            await app.delete_messages(chat_id, message_ids)
+            return
+        except FloodWait as e:
+            logger.warning(f"Delete FloodWait: sleeping {e.value}s")
+            await asyncio.sleep(e.value)
+        except Exception as e:
+            logger.error(f"Delete error: {e}")
+            return
+
+@timed("auto_delete_job")
 async def auto_delete_job():
-    """Background job to delete scheduled messages"""
+    """Delete every scheduled message whose deadline has passed"""
+    current_time = datetime.utcnow()
+    due = []
+    while delete_heap and delete_heap[0][0] <= current_time:
+        due.append(heapq.heappop(delete_heap))
+    if not due:
+        return
+    
     try:
-        current_time = datetime.utcnow()
-        messages_to_delete = await delete_queue.find({"delete_time": {"$lte": current_time}}).to_list(length=None)
+        by_chat = defaultdict(list)
+        for _, chat_id, message_id, _ in due:
+            by_chat[chat_id].append(message_id)
+        
+        for chat_id, message_ids in by_chat.items():
+            for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                await delete_message_batch(chat_id, message_ids[i:i + DELETE_BATCH_SIZE])
         
-        for msg in messages_to_delete:
+        await delete_queue.delete_many({"_id": {"$in": [row[3] for row in due]}})
+    except Exception:
+        # Put the rows back so the next run retries them
+        for row in due:
+            heapq.heappush(delete_heap, row)
+        raise
+
+async def delete_scheduler_loop():
+    """Sleep until the next deadline (or a newer one is scheduled) and run deletions"""
+    # The heap may be loaded while warming up, before the client can delete anything
+    await client_started.wait()
+    last_poll = time.monotonic()
+    while True:
+        if time.monotonic() - last_poll >= DELETE_POLL_INTERVAL:
+            last_poll = time.monotonic()
             try:
-                await app.delete_messages(msg["chat_id"], msg["message_id"])
-                await delete_queue.delete_one({"_id": msg["_id"]})
+                await poll_delete_queue()
             except Exception as e:
-                logger.error(f"Delete error: {e}")
-                await delete_queue.delete_one({"_id": msg["_id"]})
+                logger.error(f"Delete queue poll error: {e}")
+        
+        delete_wakeup.clear()
+        timeout = DELETE_POLL_INTERVAL
+        if delete_heap:
+            timeout = min(timeout, (delete_heap[0][0] - datetime.utcnow()).total_seconds())
+        
+        if timeout > 0:
+            try:
+                await asyncio.wait_for(delete_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        try:
+            await auto_delete_job()
+        except Exception as e:
+            logger.error(f"Auto delete job error: {e}")
+            await asyncio.sleep(5)
+
+# ==================== DELIVERY ====================
+# Files are sent with send_cached_media from the media file id stored at index
+# time, by a fixed pool of workers draining a bounded queue.
+delivery_queue = asyncio.Queue(maxsize=DELIVERY_QUEUE_SIZE)   # (user_id, file doc)
+delivery_tasks = []
+
+async def get_media_file_id(doc):
+    """Return the Telegram file id of a file, fetching and caching it for old records"""
+    if doc.get("media_file_id"):
+        return doc["media_file_id"]
+    
+    message = await app.get_messages(doc["channel_id"], doc["file_id"])
+    media = message and (message.document or message.video)
+    if not media:
+        return None
+    
+    await files_collection.update_one({"_id": doc["_id"]}, {"$set": {"media_file_id": media.file_id}})
+    return media.file_id
+
+async def deliver_file(user_id, doc):
+    """Send one file to a user's DM and schedule its deletion"""
+    for _ in range(3):
+        await acquire_send_slot(user_id)
+        try:
+            media_file_id = await get_media_file_id(doc)
+            if not media_file_id:
+                return "missing"
+            sent = await app.send_cached_media(
+                user_id,
+                media_file_id,
+                caption=f"📁 {doc['file_name']}\n\n⏰ This file will be deleted in 15 minutes."
+            )
+            await schedule_delete(user_id, sent.id)
+            return "sent"
+        except FloodWait as e:
+            logger.warning(f"Delivery FloodWait: backing off {e.value}s")
+            global_send_bucket.penalize(e.value)
+        except (UserIsBlocked, PeerIdInvalid, InputUserDeactivated):
+            record_user(user_id, reachable=False)
+            return "blocked"
+        except Exception as e:
+            logger.warning(f"Delivery to {user_id} failed: {e}")
+            return "failed"
+    return "failed"
+
+async def delivery_worker():
+    while True:
+        user_id, doc = await delivery_queue.get()
+        try:
+            inc("files_delivered_total", status=await deliver_file(user_id, doc))
+        except Exception as e:
+            logger.error(f"Delivery worker error: {e}")
+        finally:
+            delivery_queue.task_done()
+
+def start_delivery_workers():
+    delivery_tasks.extend(asyncio.create_task(delivery_worker()) for _ in range(DELIVERY_CONCURRENCY))
+
+# ==================== SEARCH ANALYTICS ====================
+# Searches are buffered in memory and written with insert_many off the reply
+# path. The log feeds cache warming for popular queries and the /topmisses report.
+SEARCH_LOG_BATCH_SIZE = 500
+SEARCH_LOG_MAX_BUFFER = SEARCH_LOG_BATCH_SIZE * 20   # drop the oldest rows beyond this if Mongo is down
+WARM_WINDOW = timedelta(hours=24)
+
+search_log_buffer = []
+
+def log_search(query, user_id, results):
+    """Buffer one search for the log; never blocks the handler"""
+    search_log_buffer.append({
+        "query": " ".join(tokenize(query)),
+        "text": query,
+        "user_id": user_id,
+        "results": results,
+        "at": datetime.utcnow()
+    })
+    if len(search_log_buffer) >= SEARCH_LOG_BATCH_SIZE:
+        track_flush(flush_search_log())
+
+async def flush_search_log():
+    if not search_log_buffer:
+        return
+    
+    batch = search_log_buffer[:]
+    search_log_buffer.clear()
+    try:
+        await search_log.insert_many(batch, ordered=False)
     except Exception as e:
-        logger.error(f"Auto delete job error: {e}")
+        logger.error(f"Search log flush error: {e}")
+        search_log_buffer[:0] = batch
+        del search_log_buffer[:-SEARCH_LOG_MAX_BUFFER]
+
+async def search_log_loop():
+    while True:
+        await asyncio.sleep(SEARCH_LOG_FLUSH_INTERVAL)
+        await flush_search_log()
+
+async def top_queries(since, limit, misses=False):
+    """Most searched normalized queries since a time, with hits or without"""
+    pipeline = [
+        {"$match": {"at": {"$gte": since}, "results": 0 if misses else {"$gt": 0}}},
+        {"$group": {"_id": "$query", "count": {"$sum": 1}, "users": {"$addToSet": "$user_id"}, "text": {"$last": "$text"}}},
+        {"$project": {"count": 1, "text": 1, "users": {"$size": "$users"}}},
+        {"$sort": {"count": -1}},
+        {"$limit": limit},
+    ]
+    return await search_log.aggregate(pipeline).to_list(length=limit)
+
+@timed("warm_popular_queries")
+async def warm_popular_queries():
+    """Pre-load the result cache with the most popular recent queries"""
+    try:
+        popular = await top_queries(datetime.utcnow() - WARM_WINDOW, WARM_TOP_QUERIES)
+    except Exception as e:
+        logger.error(f"Popular query lookup failed: {e}")
+        return
+    
+    # Reload rather than get, so warmed entries start a fresh TTL
+    for row in popular:
+        if row["_id"]:
+            await load_search_results(result_cache_key(row["_id"]), row["_id"], None)
+    logger.info(f"🔥 Warmed result cache with {len(popular)} popular queries")
+
+# ==================== CHANNEL INDEXER ====================
+indexed_channels = set()  # channels whose new posts are indexed live
+live_index_buffer = {}    # (channel_id, file_id) -> record waiting for the next flush
+
+def build_file_record(channel_id, message):
+    """Build a files_collection record from a channel message"""
+    media = message.document or message.video
+    if not media:
+        return None
+    
+    file_name = media.file_name or (message.caption or "").split("\n")[0].strip()
+    if not file_name:
+        return None
+    
+    # Metadata is filled in per batch by flush_index_batch. media_file_id is
+    # Telegram's file id, which send_cached_media accepts without a refetch.
+    return {
+        "file_name": file_name,
+        "file_size": media.file_size or 0,
+        "file_id": message.id,
+        "channel_id": channel_id,
+        "media_file_id": media.file_id,
+        "file_unique_id": media.file_unique_id
+    }
+
+@timed("index_batch")
+async def flush_index_batch(records):
+    """Upsert a batch of file records and add them to the search index"""
+    if not records:
+        return
+    
+    infos = parse_file_infos(
+        [record["file_name"] for record in records],
+        [record["file_size"] for record in records]
+    )
+    for record, info in zip(records, infos):
+        record.update(info)
+        record["fingerprint"] = file_fingerprint(record["file_name"], record["file_size"])
+    
+    ops = [
+        UpdateOne(
+            {"file_id": record["file_id"], "channel_id": record["channel_id"]},
+            {"$set": record},
+            upsert=True
+        )
+        for record in records
+    ]
+    result = await files_collection.bulk_write(ops, ordered=False)
+    
+    missing = defaultdict(dict)
+    for i, record in enumerate(records):
+        key = (record["channel_id"], record["file_id"])
+        doc_id = result.upserted_ids.get(i) or index_file_keys.get(key)
+        if doc_id is None:
+            missing[record["channel_id"]][record["file_id"]] = record
+            continue
+        index_file(doc_id, record["channel_id"], record["file_id"], record["file_name"], record)
+    
+    # Documents that already existed but were written by someone else
+    if missing:
+        cursor = files_collection.find(
+            {"$or": [
+                {"channel_id": channel_id, "file_id": {"$in": list(by_id)}}
+                for channel_id, by_id in missing.items()
+            ]},
+            {"file_id": 1, "channel_id": 1}
+        )
+        async for doc in cursor:
+            record = missing[doc["channel_id"]][doc["file_id"]]
+            index_file(doc["_id"], doc["channel_id"], doc["file_id"], record["file_name"], record)
+
+async def index_channel(channel_id, progress=None):
+    """Index files from a channel, resuming from the stored checkpoint"""
+    # Checkpoint fields on the channel document:
+    #   last_indexed_id - newest message covered by a completed pass
+    #   index_top_id    - newest message of the pass in progress
+    #   index_cursor_id - oldest message flushed by the pass in progress
+    channel = await channels_collection.find_one({"channel_id": channel_id}) or {}
+    floor_id = channel.get("last_indexed_id", 0)
+    top_id = channel.get("index_top_id")
+    offset_id = channel.get("index_cursor_id", 0) if top_id else 0
+    
+    started = time.monotonic()
+    last_report = started
+    scanned = 0
+    indexed = 0
+    batch = []
+    
+    async def flush(cursor_id):
+        nonlocal indexed
+        await flush_index_batch(batch)
+        indexed += len(batch)
+        batch.clear()
+        await channels_collection.update_one(
+            {"channel_id": channel_id},
+            {"$set": {"index_cursor_id": cursor_id}}
+        )
+    
+    async for message in app.get_chat_history(channel_id, offset_id=offset_id):
+        if message.id <= floor_id:
+            break
+        
+        if top_id is None:
+            top_id = message.id
+            await channels_collection.update_one(
+                {"channel_id": channel_id},
+                {"$set": {"index_top_id": top_id}},
+                upsert=True
+            )
+        
+        scanned += 1
+        record = build_file_record(channel_id, message)
+        if record:
+            batch.append(record)
+        if len(batch) >= INDEX_BATCH_SIZE:
+            await flush(message.id)
+        
+        now = time.monotonic()
+        if progress and now - last_report >= INDEX_PROGRESS_INTERVAL:
+            last_report = now
+            await progress(scanned, indexed, now - started)
+    
+    await flush_index_batch(batch)
+    indexed += len(batch)
+    
+    # Pass complete: the next run only needs messages newer than top_id
+    await channels_collection.update_one(
+        {"channel_id": channel_id},
+        {
+            "$set": {"last_indexed_id": max(top_id or 0, floor_id)},
+            "$unset": {"index_top_id": "", "index_cursor_id": ""}
+        },
+        upsert=True
+    )
+    
+    # Cached result sets may be missing the new files
+    invalidate_results()
+    return scanned, indexed, time.monotonic() - started
+
+async def load_indexed_channels():
+    """Load the registered channels for live indexing"""
+    indexed_channels.clear()
+    indexed_channels.update(await channels_collection.distinct("channel_id"))
+    logger.info(f"📢 Live indexing {len(indexed_channels)} channels")
+
+async def flush_live_index():
+    """Write buffered live posts in one bulk_write"""
+    if not live_index_buffer:
+        return
+    
+    batch = list(live_index_buffer.values())
+    live_index_buffer.clear()
+    try:
+        await flush_index_batch(batch)
+    except Exception as e:
+        logger.error(f"Live index flush error: {e}")
+        # Keep the records for the next flush unless a newer edit replaced them
+        for record in batch:
+            live_index_buffer.setdefault((record["channel_id"], record["file_id"]), record)
+        return
+    # Cached result sets were computed without these posts
+    invalidate_results()
+
+async def live_index_loop():
+    """Flush the live index buffer every INDEX_FLUSH_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(INDEX_FLUSH_INTERVAL)
+        await flush_live_index()
+
+def queue_live_record(record):
+    live_index_buffer[(record["channel_id"], record["file_id"])] = record
+    if len(live_index_buffer) >= INDEX_BATCH_SIZE:
+        track_flush(flush_live_index())
+
+async def remove_channel_files(channel_id, file_ids):
+    """Drop deleted channel posts from Mongo and the search index"""
+    for file_id in file_ids:
+        live_index_buffer.pop((channel_id, file_id), None)
+        doc_id = index_file_keys.pop((channel_id, file_id), None)
+        if doc_id is not None:
+            unindex_file(doc_id)
+    invalidate_results()
+    
+    await files_collection.delete_many({"channel_id": channel_id, "file_id": {"$in": file_ids}})
+
+def apply_file_change(change):
+    if change["operationType"] == "delete":
+        unindex_file(change["documentKey"]["_id"])
+        invalidate_results()
+        return
+    doc = change.get("fullDocument")
+    if not doc:
+        return
+    # Our own writes are already indexed; re-applying them is wasted work
+    args = (doc["_id"], doc["channel_id"], doc["file_id"], doc.get("file_name"), doc)
+    if not is_indexed(*args):
+        index_file(*args)
+        invalidate_results()
+
+async def watch_files():
+    """Apply files indexed or removed by other replicas to the local search index"""
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+    await follow_changes(files_collection, pipeline, apply_file_change)
+
+async def run_index_job(job):
+    """Index job handler: run index_channel and report throughput to the admin"""
+    channel_id = job["channel_id"]
+    
+    async def report(text):
+        try:
+            await app.edit_message_text(job["chat_id"], job["message_id"], text)
+        except Exception as e:
+            logger.warning(f"Index progress edit failed: {e}")
+    
+    async def progress(scanned, indexed, elapsed):
+        await report(
+            f"⏳ Indexing {channel_id}...\n"
+            f"📨 Messages: {scanned}\n"
+            f"📁 Files: {indexed}\n"
+            f"⚡ {scanned / elapsed:.0f} msg/s"
+        )
+    
+    indexed_channels.add(channel_id)
+    try:
+        scanned, indexed, elapsed = await index_channel(channel_id, progress)
+    except Exception as e:
+        await report(
+            f"❌ Indexing stopped: {e}\n"
+            f"Run /addchannel {channel_id} again to resume."
+        )
+        raise
+    
+    await report(
+        f"✅ Indexing complete!\n"
+        f"📨 Messages: {scanned}\n"
+        f"📁 Files: {indexed}\n"
+        f"⚡ {scanned / max(elapsed, 0.001):.0f} msg/s"
+    )
+
+# ==================== BROADCAST ====================
+# Jobs live in broadcasts_collection, one broadcast_deliveries row per recipient
+# with status pending/sent/failed/blocked, so a job survives restarts. Recipients
+# are split into user_id ranges, one "broadcast" job per range, so every live
+# replica claims a shard and sends with its share of the global rate.
+
+async def deliver_broadcast(text, user_id):
+    """Send a broadcast to one user and return the delivery status"""
+    for _ in range(3):
+        await acquire_send_slot(user_id)
+        try:
+            await app.send_message(user_id, text)
+            return "sent"
+        except FloodWait as e:
+            logger.warning(f"Broadcast FloodWait: backing off {e.value}s")
+            global_send_bucket.penalize(e.value)
+        except (UserIsBlocked, PeerIdInvalid):
+            return "blocked"
+        except InputUserDeactivated:
+            return "deactivated"
+        except Exception as e:
+            logger.warning(f"Broadcast to {user_id} failed: {e}")
+            return "failed"
+    return "failed"
+
+async def broadcast_progress_text(job_id, title):
+    job = await broadcasts_collection.find_one({"_id": job_id})
+    return (
+        f"{title}\n"
+        f"🆔 `{job_id}`\n"
+        f"👥 Total: {job['total']}\n"
+        f"✅ Success: {job.get('sent', 0)}\n"
+        f"❌ Failed: {job.get('failed', 0)}\n"
+        f"🚫 Blocked: {job.get('blocked', 0)}"
+    )
+
+async def report_broadcast(job, title):
+    try:
+        text = await broadcast_progress_text(job["_id"], title)
+        await app.edit_message_text(job["chat_id"], job["message_id"], text)
+    except Exception as e:
+        logger.warning(f"Broadcast progress edit failed: {e}")
+
+async def flush_broadcast_results(job_id, results):
+    """Persist delivery statuses and prune unreachable users"""
+    if not results:
+        return
+    
+    batch = results[:]
+    results.clear()
+    await broadcast_deliveries.bulk_write([
+        UpdateOne({"job_id": job_id, "user_id": user_id}, {"$set": {"status": status}})
+        for user_id, status in batch
+    ], ordered=False)
+    
+    counts = Counter("blocked" if status == "deactivated" else status for _, status in batch)
+    await broadcasts_collection.update_one({"_id": job_id}, {"$inc": dict(counts)})
+    
+    for user_id, status in batch:
+        if status == "blocked":
+            record_user(user_id, reachable=False)
+    deactivated = [user_id for user_id, status in batch if status == "deactivated"]
+    for user_id in deactivated:
+        pending_user_writes.pop(user_id, None)
+        reachable_cache.pop(user_id)
+    if deactivated:
+        await users_collection.delete_many({"user_id": {"$in": deactivated}})
+
+async def run_broadcast(job_id, user_from=None, user_to=None):
+    """Send a broadcast to its pending recipients in [user_from, user_to); returns how the run ended"""
+    job = await broadcasts_collection.find_one({"_id": job_id})
+    user_range = shard_range(user_from, user_to)
+    queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+    results = []
+    
+    async def sender():
+        while True:
+            user_id = await queue.get()
+            try:
+                results.append((user_id, await deliver_broadcast(job["text"], user_id)))
+            finally:
+                queue.task_done()
+    
+    senders = [asyncio.create_task(sender()) for _ in range(BROADCAST_CONCURRENCY)]
+    last_report = last_check = time.monotonic()
+    last_user_id = None
+    status = "done"
+    try:
+        while True:
+            # Keyset pages keep the cursor short-lived on huge audiences
+            query = {"job_id": job_id, "status": "pending"}
+            if last_user_id is not None:
+                query["user_id"] = {**user_range, "$gt": last_user_id}
+            elif user_range:
+                query["user_id"] = user_range
+            rows = await broadcast_deliveries.find(query, {"user_id": 1}).sort("user_id", 1).limit(1000).to_list(length=1000)
+            if not rows:
+                break
+            
+            for row in rows:
+                # Pause/cancel commands only flip the job status in Mongo
+                if time.monotonic() - last_check >= 2:
+                    last_check = time.monotonic()
+                    current = await broadcasts_collection.find_one({"_id": job_id}, {"status": 1})
+                    if current["status"] != "running":
+                        status = current["status"]
+                        break
+                
+                await queue.put(row["user_id"])
+                last_user_id = row["user_id"]
+                if len(results) >= 100:
+                    await flush_broadcast_results(job_id, results)
+                
+                if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    await report_broadcast(job, "📢 Broadcasting...")
+            
+            if status != "done":
+                break
+        
+        await queue.join()
+    finally:
+        for task in senders:
+            task.cancel()
+        await flush_broadcast_results(job_id, results)
+    
+    if status == "done":
+        # The last shard to finish completes the broadcast
+        if not await broadcast_deliveries.find_one({"job_id": job_id, "status": "pending"}, {"_id": 1}):
+            result = await broadcasts_collection.update_one({"_id": job_id, "status": "running"}, {"$set": {"status": "done"}})
+            if result.modified_count:
+                await report_broadcast(job, "✅ Broadcast Complete!")
+    elif status == "paused":
+        await report_broadcast(job, "⏸ Broadcast paused. /resumebroadcast to continue.")
+    else:
+        await report_broadcast(job, "🛑 Broadcast cancelled.")
+    return status
+
+async def run_broadcast_job(job):
+    """Broadcast shard job handler; loops if the broadcast was resumed while pausing"""
+    job_id = job["broadcast_id"]
+    while True:
+        if await run_broadcast(job_id, job.get("user_from"), job.get("user_to")) != "paused":
+            return
+        current = await broadcasts_collection.find_one({"_id": job_id}, {"status": 1})
+        if not current or current["status"] != "running":
+            return
+
+async def start_broadcast(text, status_msg):
+    """Create a broadcast job for every reachable user and start sending"""
+    # Flush first so users who just ran /start are included
+    await flush_user_writes()
+    users = sorted(await users_collection.distinct("user_id", {"reachable": True, "banned": {"$ne": True}}))
+    broadcast = {
+        "text": text,
+        "status": "running",
+        "total": len(users),
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "chat_id": status_msg.chat.id,
+        "message_id": status_msg.id,
+        "shards": broadcast_shards(users, len(live_replicas)),
+        "created_at": datetime.utcnow()
+    }
+    job_id = (await broadcasts_collection.insert_one(broadcast)).inserted_id
+    
+    for i in range(0, len(users), 1000):
+        await broadcast_deliveries.insert_many(
+            [{"job_id": job_id, "user_id": user_id, "status": "pending"} for user_id in users[i:i + 1000]],
+            ordered=False
+        )
+    
+    await enqueue_broadcast(broadcast)
+    return job_id
+
+def shard_range(user_from, user_to):
+    """Mongo condition on user_id for a [user_from, user_to) shard"""
+    user_range = {}
+    if user_from is not None:
+        user_range["$gte"] = user_from
+    if user_to is not None:
+        user_range["$lt"] = user_to
+    return user_range
+
+def broadcast_shards(users, count):
+    """Split sorted user ids into count contiguous [from, to) ranges; None is open-ended"""
+    count = max(1, min(count, len(users)))
+    edges = [None] + [users[len(users) * i // count] for i in range(1, count)] + [None]
+    return [[edges[i], edges[i + 1]] for i in range(count)]
+
+async def enqueue_broadcast(broadcast):
+    """Queue a job per shard with pending recipients; returns how many were not already active"""
+    queued = 0
+    # Broadcasts from before sharding have a single open-ended shard
+    for i, (user_from, user_to) in enumerate(broadcast.get("shards") or [[None, None]]):
+        query = {"job_id": broadcast["_id"], "status": "pending"}
+        if user_from is not None or user_to is not None:
+            query["user_id"] = shard_range(user_from, user_to)
+        if not await broadcast_deliveries.find_one(query, {"_id": 1}):
+            continue
+        key = f"broadcast:{broadcast['_id']}" + (f":{i}" if i else "")
+        queued += await enqueue_job("broadcast", key, broadcast_id=broadcast["_id"], user_from=user_from, user_to=user_to)
+    return queued
+
+async def resume_broadcasts():
+    """Queue broadcasts marked running that have no job, e.g. from before jobs existed"""
+    async for job in broadcasts_collection.find({"status": "running"}, {"shards": 1}):
+        if await enqueue_broadcast(job):
+            logger.info(f"📢 Resuming broadcast {job['_id']}")
+
+async def set_broadcast_status(from_status, to_status):
+    """Move the latest broadcast in from_status to to_status"""
+    return await broadcasts_collection.find_one_and_update(
+        {"status": {"$in": from_status}},
+        {"$set": {"status": to_status}},
+        sort=[("created_at", -1)]
+    )
+
+# ==================== REPLICAS ====================
+# Replicas coordinate through leases in Mongo: every replica heartbeats a
+# "replica:<id>" lease, updates are split between the live replicas by user or
+# chat id, and the holder of the "leader" lease runs the delete scheduler.
+# Index and broadcast jobs are claimed atomically from jobs_collection.
+live_replicas = [REPLICA_ID]   # sorted ids of replicas with a live heartbeat
+is_leader = False
+leader_tasks = []              # tasks that only run on the leader
+running_jobs = {}              # job _id -> task running it on this replica
+job_wakeup = asyncio.Event()
+
+async def acquire_lease(name, ttl=LEASE_TTL, **fields):
+    """Take or renew a named lease; True while this replica holds it"""
+    now = datetime.utcnow()
+    try:
+        lease = await leases_collection.find_one_and_update(
+            {"_id": name, "$or": [{"holder": REPLICA_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": REPLICA_ID, "expires_at": now + timedelta(seconds=ttl), **fields}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # The lease exists and someone else still holds it
+        return False
+    return lease is not None
+
+async def release_lease(name):
+    await leases_collection.delete_one({"_id": name, "holder": REPLICA_ID})
+
+def owns_update(key):
+    """Rendezvous hashing: True if this replica handles updates for key"""
+    if len(live_replicas) == 1:
+        return True
+    owner = max(live_replicas, key=lambda replica: zlib.crc32(f"{replica}:{key}".encode()))
+    return owner == REPLICA_ID
+
+async def refresh_replicas():
+    """Heartbeat this replica and reload the set of live ones"""
+    # A lone replica handles every update
+    if not MULTI_REPLICA:
+        return
+    
+    await acquire_lease(f"replica:{REPLICA_ID}", kind="replica")
+    rows = await leases_collection.find(
+        {"kind": "replica", "expires_at": {"$gt": datetime.utcnow()}},
+        {"holder": 1}
+    ).to_list(length=None)
+    set_live_replicas({row["holder"] for row in rows})
+
+def set_live_replicas(replicas):
+    global live_replicas
+    
+    live_replicas = sorted(set(replicas) | {REPLICA_ID})
+    # Telegram and group limits are per bot, so each replica gets its share
+    global_send_bucket.rate = TELEGRAM_GLOBAL_RATE / len(live_replicas)
+    group_search_bucket.rate = SEARCH_GROUP_RATE / len(live_replicas)
+
+def apply_replica_change(change):
+    replica = change["documentKey"]["_id"].removeprefix("replica:")
+    if change["operationType"] == "delete":
+        set_live_replicas(r for r in live_replicas if r != replica)
+    elif replica not in live_replicas:
+        set_live_replicas([*live_replicas, replica])
+
+async def watch_replicas():
+    """Pick up replicas joining or leaving between heartbeats, e.g. during a redeploy"""
+    pipeline = [{"$match": {
+        "operationType": {"$in": ["insert", "delete"]},
+        "documentKey._id": {"$regex": "^replica:"}
+    }}]
+    await follow_changes(leases_collection, pipeline, apply_replica_change)
+
+async def start_leader_duties():
+    logger.info(f"👑 {REPLICA_ID} is now the leader")
+    await load_delete_queue()
+    leader_tasks.append(asyncio.create_task(delete_scheduler_loop()))
+
+def stop_leader_duties():
+    logger.warning(f"👑 {REPLICA_ID} lost the leader lease")
+    for task in leader_tasks:
+        task.cancel()
+    leader_tasks.clear()
+    delete_heap.clear()
+
+async def replica_tick():
+    """Renew leases, track leadership and keep claimed jobs alive"""
+    global is_leader
+    
+    try:
+        await refresh_replicas()
+        leader = await acquire_lease("leader")
+        if running_jobs:
+            await jobs_collection.update_many(
+                {"_id": {"$in": list(running_jobs)}, "holder": REPLICA_ID},
+                {"$set": {"lease_expires": datetime.utcnow() + timedelta(seconds=LEASE_TTL)}}
+            )
+        # Channels added through another replica
+        indexed_channels.update(await channels_collection.distinct("channel_id"))
+    except Exception as e:
+        logger.error(f"Lease renewal failed: {e}")
+        leader = False
+    
+    if leader and not is_leader:
+        is_leader = True
+        await start_leader_duties()
+    elif not leader and is_leader:
+        is_leader = False
+        stop_leader_duties()
+
+async def replica_loop():
+    while True:
+        await asyncio.sleep(LEASE_TTL / 3)
+        await replica_tick()
+
+async def enqueue_job(kind, key, **fields):
+    """Queue a background job; returns False if one with the same key is already active"""
+    try:
+        await jobs_collection.insert_one({
+            "kind": kind,
+            "key": key,
+            "active": True,
+            "status": "pending",
+            "attempts": 0,
+            "created_at": datetime.utcnow(),
+            **fields
+        })
+    except DuplicateKeyError:
+        return False
+    job_wakeup.set()
+    return True
+
+async def claim_job():
+    """Atomically take the oldest pending job, or one whose holder stopped renewing it"""
+    now = datetime.utcnow()
+    return await jobs_collection.find_one_and_update(
+        {"active": True, "$or": [{"status": "pending"}, {"lease_expires": {"$lt": now}}]},
+        {
+            "$set": {"status": "running", "holder": REPLICA_ID, "lease_expires": now + timedelta(seconds=LEASE_TTL)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def run_job(job):
+    status = "done"
+    try:
+        await JOB_HANDLERS[job["kind"]](job)
+    except Exception as e:
+        logger.error(f"Job {job['key']} failed: {e}")
+        status = "failed"
+    finally:
+        running_jobs.pop(job["_id"], None)
+    
+    await jobs_collection.update_one(
+        {"_id": job["_id"], "holder": REPLICA_ID},
+        {"$set": {"status": status, "finished_at": datetime.utcnow()}, "$unset": {"active": ""}}
+    )
+    
+    # A /resumebroadcast landing after run_broadcast_job's last status check
+    # could not enqueue while this job was active; pick it up now
+    if job["kind"] == "broadcast" and status == "done":
+        broadcast = await broadcasts_collection.find_one({"_id": job["broadcast_id"], "status": "running"}, {"shards": 1})
+        if broadcast:
+            await enqueue_broadcast(broadcast)
+
+async def job_worker_loop():
+    """Claim jobs up to JOB_CONCURRENCY and run them"""
+    while True:
+        job_wakeup.clear()
+        try:
+            while len(running_jobs) < JOB_CONCURRENCY:
+                job = await claim_job()
+                if job is None:
+                    break
+                logger.info(f"🧰 Claimed job {job['key']} (attempt {job['attempts']})")
+                running_jobs[job["_id"]] = asyncio.create_task(run_job(job))
+        except Exception as e:
+            logger.error(f"Job claim error: {e}")
+        
+        try:
+            await asyncio.wait_for(job_wakeup.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+JOB_HANDLERS = {
+    "index": run_index_job,
+    "broadcast": run_broadcast_job,
+}
+
+# ==================== SCHEMA ====================
+# Every index the bot relies on, declared in one place and created at startup
+REQUIRED_INDEXES = [
+    (files_collection, [
+        IndexModel([("file_id", ASCENDING), ("channel_id", ASCENDING)], unique=True, name="file_channel_unique"),
+    ]),
+    (users_collection, [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("banned", ASCENDING)], partialFilterExpression={"banned": True}, name="banned_users"),
+        IndexModel([("reachable", ASCENDING)], partialFilterExpression={"reachable": True}, name="reachable_users"),
+    ]),
+    (channels_collection, [
+        IndexModel([("channel_id", ASCENDING)], unique=True, name="channel_id_unique"),
+    ]),
+    (delete_queue, [
+        IndexModel([("delete_time", ASCENDING)], expireAfterSeconds=DELETE_RETENTION, name="delete_time_ttl"),
+    ]),
+    (broadcasts_collection, [
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING)], name="status_created"),
+    ]),
+    (broadcast_deliveries, [
+        IndexModel([("job_id", ASCENDING), ("user_id", ASCENDING)], unique=True, name="job_user_unique"),
+        IndexModel([("job_id", ASCENDING), ("status", ASCENDING), ("user_id", ASCENDING)], name="job_pending"),
+    ]),
+    (sessions_collection, [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ]),
+    (search_log, [
+        IndexModel([("at", ASCENDING)], expireAfterSeconds=SEARCH_LOG_RETENTION_DAYS * 86400, name="at_ttl"),
+    ]),
+    (leases_collection, [
+        IndexModel([("kind", ASCENDING), ("expires_at", ASCENDING)], name="kind_expires"),
+    ]),
+    (jobs_collection, [
+        # At most one active job per key, e.g. one index job per channel
+        IndexModel([("key", ASCENDING)], unique=True, partialFilterExpression={"active": True}, name="active_key_unique"),
+        IndexModel([("active", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING)], name="active_status_created"),
+    ]),
+]
+
+# (collection, filter, sort) shapes of the hot queries, checked with explain()
+CANONICAL_QUERIES = [
+    (files_collection, {"_id": {"$in": [ObjectId()]}}, None),
+    (files_collection, {"channel_id": 0, "file_id": {"$in": [0]}}, None),
+    (users_collection, {"user_id": 0}, None),
+    (users_collection, {"banned": True}, None),
+    (users_collection, {"reachable": True}, None),
+    (channels_collection, {"channel_id": 0}, None),
+    (delete_queue, {"delete_time": {"$lte": datetime.utcnow()}}, None),
+    (broadcasts_collection, {"status": {"$in": ["running"]}}, [("created_at", DESCENDING)]),
+    (broadcast_deliveries, {"job_id": ObjectId(), "status": "pending", "user_id": {"$gt": 0}}, [("user_id", ASCENDING)]),
+    (search_log, {"at": {"$gte": datetime.utcnow()}, "results": 0}, None),
+    (leases_collection, {"kind": "replica", "expires_at": {"$gt": datetime.utcnow()}}, None),
+    (jobs_collection, {"active": True, "status": "pending"}, [("created_at", ASCENDING)]),
+]
+
+def plan_has_collscan(plan):
+    """Look for a COLLSCAN stage anywhere in an explain() plan"""
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(plan_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(plan_has_collscan(value) for value in plan)
+    return False
+
+async def ensure_indexes():
+    """Create the required indexes and warn about hot queries that scan collections"""
+    for collection, models in REQUIRED_INDEXES:
+        for model in models:
+            # One at a time so a conflicting legacy index only skips itself
+            try:
+                await collection.create_indexes([model])
+            except Exception as e:
+                logger.warning(f"Index {collection.name}.{model.document['name']} not created: {e}")
+    
+    for collection, query, sort in CANONICAL_QUERIES:
+        try:
+            cursor = collection.find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            explain = await cursor.explain()
+        except Exception as e:
+            logger.warning(f"Explain failed on {collection.name} {query}: {e}")
+            continue
+        
+        if plan_has_collscan(explain.get("queryPlanner", {}).get("winningPlan")):
+            logger.warning(f"⚠️ COLLSCAN on {collection.name} for {query}")
+    
+    logger.info("🗂 Indexes checked")
+
+# ==================== ADMISSION ====================
+# Cheap checks in front of handle_search, before any Mongo or Telegram call
+LINK_PATTERN = re.compile(r"(https?://|www\.|t\.me/|@\w{4,})", re.IGNORECASE)
+LINK_ENTITY_TYPES = {
+    enums.MessageEntityType.URL,
+    enums.MessageEntityType.TEXT_LINK,
+    enums.MessageEntityType.MENTION,
+    enums.MessageEntityType.TEXT_MENTION
+}
+
+user_search_buckets = TTLCache(20000, 600)            # user_id -> TokenBucket
+search_cooldowns = TTLCache(20000, SEARCH_COOLDOWN)   # user_id -> True while cooling down
+group_search_bucket = TokenBucket(SEARCH_GROUP_RATE, SEARCH_GROUP_RATE * 2)
+
+def is_search_query(message):
+    """Skip chatter that is obviously not a file search"""
+    text = (message.text or "").strip()
+    if len(text) < 2 or len(text) > 100 or text.startswith("/"):
+        return False
+    
+    # Emoji/sticker-style messages without letters or digits
+    if not any(ch.isalnum() for ch in text):
+        return False
+    
+    # Links and mentions
+    if LINK_PATTERN.search(text) or any(
+        entity.type in LINK_ENTITY_TYPES for entity in message.entities or ()
+    ):
+        return False
+    
+    # One-word replies to someone else's message
+    if message.reply_to_message and len(text.split()) < 2:
+        return False
+    
+    return True
+
+def admit_search(user_id):
+    """Per-user token bucket with a cooldown, then the group-wide budget"""
+    if search_cooldowns.get(user_id):
+        return False
+    
+    bucket = user_search_buckets.get(user_id)
+    if bucket is None:
+        bucket = TokenBucket(SEARCH_USER_RATE, SEARCH_USER_BURST)
+        user_search_buckets.set(user_id, bucket)
+    
+    if not bucket.try_acquire():
+        search_cooldowns.set(user_id, True)
+        return False
+    
+    return group_search_bucket.try_acquire()
 
 # ==================== BOT HANDLERS ====================
 
+# Every replica receives every update; each keeps only the users/chats it owns
+@app.on_message(group=-2)
+async def route_message(client, message):
+    if not owns_update(message.from_user.id if message.from_user else message.chat.id):
+        raise StopPropagation
+
+@app.on_edited_message(group=-2)
+async def route_edited_message(client, message):
+    if not owns_update(message.from_user.id if message.from_user else message.chat.id):
+        raise StopPropagation
+
+@app.on_callback_query(group=-2)
+async def route_callback(client, callback):
+    if not owns_update(callback.from_user.id):
+        raise StopPropagation
+
+@app.on_deleted_messages(group=-2)
+async def route_deleted_messages(client, messages):
+    chat = messages[0].chat if messages else None
+    if not owns_update(chat.id if chat else 0):
+        raise StopPropagation
+
+@app.on_message(group=-1)
+async def count_messages(client, message):
+    inc("bot_updates_total", type="message")
+
+@app.on_callback_query(group=-1)
+async def count_callbacks(client, callback):
+    inc("bot_updates_total", type="callback_query")
+
 @app.on_message(filters.command("start") & filters.private)
 async def start_command(client, message):
-    if await is_banned(message.from_user.id):
+    if is_banned(message.from_user.id):
         return await message.reply("❌ You are banned from using this bot.")
     
+    # Writing to the bot in private opens the DM
+    record_user(message.from_user.id, reachable=True)
+    
     await message.reply(
         "👋 **Welcome to File Sharing Bot!**\n\n"
         "🔍 Search for files in the group\n"
@@ -260,9 +2216,14 @@ async def handle_search(client, message):
     if message.chat.id != GROUP_ID:
         return
     
-    if await is_banned(message.from_user.id):
+    if not message.from_user or is_banned(message.from_user.id):
         return
     
+    if not is_search_query(message) or not admit_search(message.from_user.id):
+        return
+    
+    user_id = message.from_user.id
+    record_user(user_id)
     query = message.text.strip()
     
     # Show loading
@@ -270,18 +2231,23 @@ async def handle_search(client, message):
     
     try:
         # Search files
-        files = await search_files(query)
+        entry = await get_search_results(query)
+        log_search(query, message.from_user.id, entry["count"])
         
         # If no results, try fuzzy search
-        if not files:
-            suggestions = await fuzzy_search(query)
+        if not entry["count"]:
+            suggestions = await single_flight(
+                ("fuzzy", result_cache_key(query)),
+                lambda: fuzzy_search(query)
+            )
             
             if suggestions:
+                session = await create_session(query, suggestions=suggestions[:5])
                 keyboard = []
-                for suggestion in suggestions[:5]:
+                for i, (_, file_name) in enumerate(session["suggestions"]):
                     keyboard.append([InlineKeyboardButton(
-                        f"🔍 {suggestion[:50]}...",
-                        callback_data=f"fuzzy_search_{suggestion}"
+                        f"🔍 {file_name[:50]}...",
+                        callback_data=f"fz:{session['_id']}:{i}"
                     )])
                 
                 await loading_msg.edit(
@@ -297,29 +2263,24 @@ async def handle_search(client, message):
             await schedule_delete(message.chat.id, message.id)
             return
         
-        # Send results to DM
-        total_results = len(files)
-        total_pages = (total_results + 9) // 10
-        
-        result_text = f"📁 **Results for \"{query}\"** - {total_results} files found\n\n"
-        
-        # First page (10 results)
-        for file in files[:10]:
-            size = format_size(file.get("file_size", 0))
-            result_text += f"[{size}] {file['file_name']}\n\n"
-        
-        keyboard = create_result_keyboard(1, total_pages, query=query)
-        
-        try:
-            sent = await client.send_message(
-                message.from_user.id,
-                result_text,
-                reply_markup=keyboard
-            )
-            await schedule_delete(message.from_user.id, sent.id)
-            await loading_msg.edit("✅ **Results sent to DM!**")
-        except Exception as e:
+        # Send results to DM, unless we already know the DM is closed
+        if await is_reachable(user_id) is False:
             await loading_msg.edit("❌ Please start the bot in DM first: @YourBotUsername")
+        else:
+            session = await create_session(query)
+            result_text, keyboard = await render_results(session, entry, 1)
+            
+            try:
+                sent = await client.send_message(user_id, result_text, reply_markup=keyboard)
+                record_user(user_id, reachable=True)
+                await schedule_delete(user_id, sent.id)
+                await loading_msg.edit("✅ **Results sent to DM!**")
+            except (UserIsBlocked, PeerIdInvalid, InputUserDeactivated):
+                record_user(user_id, reachable=False)
+                await loading_msg.edit("❌ Please start the bot in DM first: @YourBotUsername")
+            except Exception as e:
+                logger.warning(f"Results DM to {user_id} failed: {e}")
+                await loading_msg.edit("❌ Couldn't send the results to your DM. Try again.")
         
         await schedule_delete(message.chat.id, loading_msg.id)
         await schedule_delete(message.chat.id, message.id)
@@ -329,98 +2290,137 @@ async def handle_search(client, message):
         await loading_msg.edit("❌ Search failed. Try again.")
         await schedule_delete(message.chat.id, loading_msg.id)
 
+async def show_results(callback, session, page):
+    entry = await get_search_results(session["query"], session["filters"])
+    result_text, keyboard = await render_results(session, entry, page)
+    await callback.message.edit(result_text, reply_markup=keyboard)
+
+async def on_fuzzy_callback(client, callback, session, arg):
+    """Run the search for a picked suggestion"""
+    # Search the title, not the file name on the button, to get every release of it
+    session["query"] = session["suggestions"][int(arg)][0]
+    session["filters"] = {}
+    await save_session(session)
+    
+    await callback.message.edit("🔄 **Searching...**")
+    await show_results(callback, session, 1)
+
+async def on_page_callback(client, callback, session, arg):
+    await show_results(callback, session, int(arg))
+
+async def on_filter_menu_callback(client, callback, session, arg):
+    filter_type, _, page = arg.partition(".")
+    if filter_type not in FILTER_TYPES:
+        return
+    
+    entry = await get_search_results(session["query"], session["filters"])
+    counts = get_facet(entry, session["query"], session["filters"], filter_type)
+    keyboard = create_filter_keyboard(filter_type, session["_id"], int(page or 1), counts)
+    
+    text = f"🎯 **Select {filter_type.title()}:**" if counts else f"🎯 No {filter_type} info in these results."
+    await callback.message.edit(text, reply_markup=keyboard)
+
+async def on_set_filter_callback(client, callback, session, arg):
+    """Add a filter to the session; filters of other types stay applied"""
+    filter_type, _, value = arg.partition("=")
+    if filter_type not in FILTER_TYPES:
+        return
+    
+    session["filters"][filter_type] = FILTER_TYPES[filter_type](value)
+    await save_session(session)
+    await show_results(callback, session, 1)
+
+async def on_clear_filters_callback(client, callback, session, arg):
+    session["filters"] = {}
+    await save_session(session)
+    await show_results(callback, session, 1)
+
+async def on_back_callback(client, callback, session, arg):
+    await show_results(callback, session, int(arg))
+
+async def on_get_file_callback(client, callback, session, arg):
+    """Queue the tapped file for delivery to the user's DM"""
+    doc = await files_collection.find_one(
+        {"_id": ObjectId(arg)},
+        {"file_name": 1, "channel_id": 1, "file_id": 1, "media_file_id": 1}
+    )
+    if not doc:
+        return await callback.answer("❌ This file is no longer available.", show_alert=True)
+    
+    try:
+        delivery_queue.put_nowait((callback.from_user.id, doc))
+    except asyncio.QueueFull:
+        return await callback.answer("⏳ Too many downloads right now, try again in a minute.", show_alert=True)
+    return await callback.answer("📥 Sending the file to your DM...")
+
+CALLBACK_HANDLERS = {
+    "fz": on_fuzzy_callback,
+    "pg": on_page_callback,
+    "fm": on_filter_menu_callback,
+    "fs": on_set_filter_callback,
+    "fc": on_clear_filters_callback,
+    "bk": on_back_callback,
+    "gf": on_get_file_callback,
+}
+
 @app.on_callback_query()
 async def handle_callbacks(client, callback: CallbackQuery):
     data = callback.data
     user_id = callback.from_user.id
     
-    if await is_banned(user_id):
+    if is_banned(user_id):
         return await callback.answer("You are banned!", show_alert=True)
     
     try:
-        # Fuzzy search selection
-        if data.startswith("fuzzy_search_"):
-            query = data.replace("fuzzy_search_", "")
-            await callback.message.edit("🔄 **Searching...**")
-            
-            files = await search_files(query)
-            total_results = len(files)
-            total_pages = (total_results + 9) // 10
-            
-            result_text = f"📁 **Results for \"{query}\"** - {total_results} files found\n\n"
-            
-            for file in files[:10]:
-                size = format_size(file.get("file_size", 0))
-                result_text += f"[{size}] {file['file_name']}\n\n"
-            
-            keyboard = create_result_keyboard(1, total_pages, query=query)
-            await callback.message.edit(result_text, reply_markup=keyboard)
-        
-        # Pagination
-        elif data.startswith("page_"):
-            parts = data.split("_")
-            query = parts[1]
-            page = int(parts[2])
-            
-            files = await search_files(query)
-            total_results = len(files)
-            total_pages = (total_results + 9) // 10
-            
-            start = (page - 1) * 10
-            end = start + 10
-            
-            result_text = f"📁 **Results for \"{query}\"** - {total_results} files found\n\n"
-            
-            for file in files[start:end]:
-                size = format_size(file.get("file_size", 0))
-                result_text += f"[{size}] {file['file_name']}\n\n"
-            
-            keyboard = create_result_keyboard(page, total_pages, query=query)
-            await callback.message.edit(result_text, reply_markup=keyboard)
-        
-        # Filter buttons
-        elif data.startswith("filter_"):
-            parts = data.split("_")
-            filter_type = parts[1]
-            query = parts[2]
-            page = int(parts[3])
-            
-            keyboard = create_filter_keyboard(filter_type, query, page)
-            await callback.message.edit(
-                f"🎯 **Select {filter_type.title()}:**",
-                reply_markup=keyboard
-            )
+        parts = data.split(":", 2)
+        handler = CALLBACK_HANDLERS.get(parts[0])
+        if handler is None:
+            return await callback.answer()
         
-        # Set filter and search
-        elif data.startswith("setfilter_"):
-            parts = data.split("_")
-            filter_type = parts[1]
-            filter_value = parts[2]
-            query = parts[3]
-            page = int(parts[4])
-            
-            filters = {filter_type: filter_value}
-            files = await search_files(query, filters)
-            
-            total_results = len(files)
-            total_pages = (total_results + 9) // 10
-            
-            result_text = f"📁 **Filtered Results** - {total_results} files\n"
-            result_text += f"🎯 {filter_type.title()}: {filter_value}\n\n"
-            
-            for file in files[:10]:
-                size = format_size(file.get("file_size", 0))
-                result_text += f"[{size}] {file['file_name']}\n\n"
-            
-            keyboard = create_result_keyboard(1, total_pages, query=query)
-            await callback.message.edit(result_text, reply_markup=keyboard)
+        _, token, arg = parts
+        session = await get_session(token)
+        if session is None:
+            return await callback.answer("⌛ This search has expired. Search again in the group.", show_alert=True)
         
-        await callback.answer()
+        # Handlers that answer with their own text return the answer's result
+        if not await handler(client, callback, session, arg):
+            await callback.answer()
     
     except Exception as e:
         logger.error(f"Callback error: {e}")
         await callback.answer("Error occurred!", show_alert=True)
 
+@app.on_message(filters.channel & (filters.document | filters.video))
+async def live_index_post(client, message):
+    if message.chat.id not in indexed_channels:
+        return
+    
+    record = build_file_record(message.chat.id, message)
+    if record:
+        queue_live_record(record)
+
+@app.on_edited_message(filters.channel)
+async def live_index_edit(client, message):
+    if message.chat.id not in indexed_channels:
+        return
+    
+    record = build_file_record(message.chat.id, message)
+    if record:
+        queue_live_record(record)
+    elif (message.chat.id, message.id) in index_file_keys:
+        await remove_channel_files(message.chat.id, [message.id])
+
+@app.on_deleted_messages()
+async def live_index_delete(client, messages):
+    deleted = defaultdict(list)
+    for message in messages:
+        # Only channel deletions carry the chat they belong to
+        if message.chat and message.chat.id in indexed_channels:
+            deleted[message.chat.id].append(message.id)
+    
+    for channel_id, file_ids in deleted.items():
+        await remove_channel_files(channel_id, file_ids)
+
 # ==================== ADMIN COMMANDS ====================
 
 @app.on_message(filters.command("broadcast") & filters.user(ADMIN_IDS))
@@ -429,25 +2429,31 @@ async def broadcast_message(client, message):
         return await message.reply("Usage: /broadcast <message>")
     
     broadcast_text = message.text.split(None, 1)[1]
-    users = await users_collection.distinct("user_id")
-    
-    success = 0
-    failed = 0
-    
     status_msg = await message.reply("📢 Broadcasting...")
-    
-    for user_id in users:
-        try:
-            await client.send_message(user_id, broadcast_text)
-            success += 1
-        except:
-            failed += 1
-    
-    await status_msg.edit(
-        f"✅ Broadcast Complete!\n"
-        f"✅ Success: {success}\n"
-        f"❌ Failed: {failed}"
-    )
+    await start_broadcast(broadcast_text, status_msg)
+
+@app.on_message(filters.command("pausebroadcast") & filters.user(ADMIN_IDS))
+async def pause_broadcast_command(client, message):
+    job = await set_broadcast_status(["running"], "paused")
+    if not job:
+        return await message.reply("❌ No running broadcast.")
+    await message.reply(f"⏸ Pausing broadcast `{job['_id']}`...")
+
+@app.on_message(filters.command("resumebroadcast") & filters.user(ADMIN_IDS))
+async def resume_broadcast_command(client, message):
+    job = await set_broadcast_status(["paused"], "running")
+    if not job:
+        return await message.reply("❌ No paused broadcast.")
+    # Shards still winding down from the pause are queued again by run_job when they exit
+    await enqueue_broadcast(job)
+    await message.reply(f"▶️ Broadcast `{job['_id']}` resumed.")
+
+@app.on_message(filters.command("cancelbroadcast") & filters.user(ADMIN_IDS))
+async def cancel_broadcast_command(client, message):
+    job = await set_broadcast_status(["running", "paused"], "cancelled")
+    if not job:
+        return await message.reply("❌ No active broadcast.")
+    await message.reply(f"🛑 Broadcast `{job['_id']}` cancelled.")
 
 @app.on_message(filters.command("ban") & filters.user(ADMIN_IDS))
 async def ban_user_command(client, message):
@@ -480,87 +2486,309 @@ async def add_channel(client, message):
     
     try:
         channel_id = int(message.command[1])
-        await channels_collection.insert_one({"channel_id": channel_id})
-        await message.reply(f"✅ Channel {channel_id} added. Indexing files...")
+        if await jobs_collection.find_one({"key": f"index:{channel_id}", "active": True}, {"_id": 1}):
+            return await message.reply(f"⏳ Channel {channel_id} is already being indexed.")
         
-        # Index files from channel
-        await index_channel(channel_id)
-        await message.reply("✅ Indexing complete!")
+        await channels_collection.update_one(
+            {"channel_id": channel_id},
+            {"$setOnInsert": {"channel_id": channel_id}},
+            upsert=True
+        )
+        status_msg = await message.reply(f"✅ Channel {channel_id} added. Indexing files...")
+        
+        # Whichever replica claims the job indexes the channel
+        indexed_channels.add(channel_id)
+        await enqueue_job(
+            "index", f"index:{channel_id}",
+            channel_id=channel_id, chat_id=status_msg.chat.id, message_id=status_msg.id
+        )
     except ValueError:
         await message.reply("❌ Invalid channel ID")
 
-async def index_channel(channel_id):
-    """Index all files from a channel"""
-    try:
-        async for message in app.get_chat_history(channel_id):
-            if message.document or message.video:
-                file_name = message.document.file_name if message.document else message.video.file_name
-                file_size = message.document.file_size if message.document else message.video.file_size
-                
-                info = parse_file_info(file_name)
-                
-                await files_collection.update_one(
-                    {"file_id": message.id, "channel_id": channel_id},
-                    {"$set": {
-                        "file_name": file_name,
-                        "file_size": file_size,
-                        "file_id": message.id,
-                        "channel_id": channel_id,
-                        "quality": info["quality"],
-                        "year": info["year"],
-                        "language": info["language"],
-                        "season": info["season"]
-                    }},
-                    upsert=True
-                )
-    except Exception as e:
-        logger.error(f"Indexing error: {e}")
-
 @app.on_message(filters.command("stats") & filters.user(ADMIN_IDS))
 async def show_stats(client, message):
     total_files = await files_collection.count_documents({})
     total_users = await users_collection.count_documents({})
+    reachable_users = await users_collection.count_documents({"reachable": True})
     total_channels = await channels_collection.count_documents({})
     
     await message.reply(
         f"📊 **Bot Statistics**\n\n"
         f"📁 Total Files: {total_files}\n"
-        f"👥 Total Users: {total_users}\n"
+        f"👥 Total Users: {total_users} ({reachable_users} reachable in DM)\n"
         f"📢 Total Channels: {total_channels}"
     )
 
+@app.on_message(filters.command("topmisses") & filters.user(ADMIN_IDS))
+async def show_top_misses(client, message):
+    """Most frequent searches without results over the last N days (default 7)"""
+    days = 7
+    if len(message.command) > 1 and message.command[1].isdigit():
+        days = int(message.command[1])
+    
+    await flush_search_log()
+    misses = await top_queries(datetime.utcnow() - timedelta(days=days), 20, misses=True)
+    if not misses:
+        return await message.reply(f"✅ No zero-result searches in the last {days} days.")
+    
+    lines = [f"🕳 **Top Misses ({days} days)**\n"]
+    for i, row in enumerate(misses, 1):
+        lines.append(f"{i}. {row['text']} — {row['count']} searches, {row['users']} users")
+    lines.append("\nConsider adding channels that carry these titles.")
+    await message.reply("\n".join(lines))
+
+@app.on_message(filters.command("duplicates") & filters.user(ADMIN_IDS))
+async def show_duplicates(client, message):
+    """Report duplicate files per channel and the space they take up"""
+    by_channel = defaultdict(lambda: [0, 0])
+    for channel_id, _, _, info in duplicate_files.values():
+        by_channel[channel_id][0] += 1
+        by_channel[channel_id][1] += info.get("file_size") or 0
+    
+    if not by_channel:
+        return await message.reply("✅ No duplicate files found.")
+    
+    total_size = sum(size for _, size in by_channel.values())
+    lines = [
+        "♻️ **Duplicate Files**\n",
+        f"📁 {len(duplicate_files)} duplicates in {len(dedup_groups)} groups",
+        f"💾 Reclaimable: {format_size(total_size)}\n"
+    ]
+    ranked = sorted(by_channel.items(), key=lambda item: -item[1][0])
+    for channel_id, (count, size) in ranked[:20]:
+        lines.append(f"📢 `{channel_id}`: {count} files, {format_size(size)}")
+    if len(ranked) > 20:
+        lines.append(f"... and {len(ranked) - 20} more channels")
+    
+    await message.reply("\n".join(lines))
+
 # ==================== HEALTH CHECK FOR RENDER ====================
 
 async def health_check(request):
     return web.Response(text="Bot is running! ✅", status=200)
 
+async def readiness_check(request):
+    """Report whether warm-up finished and Mongo and Telegram are reachable"""
+    checks = {"ready": bot_ready and not shutting_down, "telegram": app.is_connected}
+    try:
+        await asyncio.wait_for(mongo_client.admin.command("ping"), timeout=3)
+        checks["mongo"] = True
+    except Exception as e:
+        logger.warning(f"Mongo health check failed: {e}")
+        checks["mongo"] = False
+    
+    healthy = all(checks.values())
+    return web.json_response(
+        {"status": "ok" if healthy else "unhealthy", **checks},
+        status=200 if healthy else 503
+    )
+
+async def metrics_endpoint(request):
+    counters = [
+        ("result_cache_hits_total", "Result cache hits", result_cache.hits),
+        ("result_cache_misses_total", "Result cache misses", result_cache.misses),
+        ("session_cache_hits_total", "Session cache hits", session_cache.hits),
+        ("session_cache_misses_total", "Session cache misses", session_cache.misses),
+    ]
+    gauges = [
+        ("result_cache_entries", "Cached result sets", len(result_cache)),
+        ("delete_queue_depth", "Scheduled deletions waiting", len(delete_heap)),
+        ("search_index_files", "Files in the search index", len(index_doc_tokens)),
+        ("search_index_tokens", "Distinct tokens in the search index", len(index_postings)),
+        ("duplicate_files", "Indexed files hidden as duplicates of another file", len(duplicate_files)),
+        ("live_index_buffer", "Channel posts waiting to be indexed", len(live_index_buffer)),
+        ("banned_users", "Banned users", len(banned_users)),
+        ("replicas_live", "Replicas with a live heartbeat", len(live_replicas)),
+        ("replica_is_leader", "1 if this replica holds the leader lease", int(is_leader)),
+        ("jobs_running", "Background jobs running on this replica", len(running_jobs)),
+        ("delivery_queue_depth", "File deliveries waiting to be sent", delivery_queue.qsize()),
+        ("search_log_buffer", "Searches waiting to be written to the log", len(search_log_buffer)),
+        ("user_writes_pending", "User registry updates waiting to be written", len(pending_user_writes)),
+    ]
+    return web.Response(text=render_metrics(gauges, counters), content_type="text/plain", charset="utf-8")
+
 async def start_web_server():
+    global web_runner
+    
     app_web = web.Application()
     app_web.router.add_get("/", health_check)
-    app_web.router.add_get("/health", health_check)
+    app_web.router.add_get("/health", readiness_check)
+    app_web.router.add_get("/metrics", metrics_endpoint)
     
-    runner = web.AppRunner(app_web)
+    runner = web_runner = web.AppRunner(app_web)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
     logger.info(f"🌐 Web server started on port {PORT}")
 
+# ==================== LIFECYCLE ====================
+# Startup warms every in-memory structure before /health reports ready;
+# SIGTERM stops taking updates, lets background work reach a checkpoint and
+# flushes the write-behind buffers before the client disconnects.
+bot_ready = False
+shutting_down = False
+client_started = asyncio.Event()
+stop_event = asyncio.Event()
+background_tasks = []   # long-running loops, cancelled on shutdown
+flush_tasks = set()     # threshold flushes of write-behind buffers, awaited on shutdown
+web_runner = None
+
+def track_flush(coro):
+    """Run a buffer flush in the background, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    flush_tasks.add(task)
+    task.add_done_callback(flush_tasks.discard)
+
+async def wait_for_flushes():
+    # Their batches are already out of the buffers, so the final flushes would miss them
+    if flush_tasks:
+        await asyncio.gather(*flush_tasks, return_exceptions=True)
+
+async def warm_up():
+    """Load the search index, ban set, channels and (on the leader) delete heap concurrently"""
+    async def warm_search():
+        await build_search_index()
+        await warm_popular_queries()
+    
+    started = time.monotonic()
+    await asyncio.gather(warm_search(), load_banned_users(), load_indexed_channels(), replica_tick())
+    logger.info(f"🔥 Warm-up finished in {time.monotonic() - started:.1f}s")
+
+async def stop_updates(timeout):
+    """Let handler workers finish the updates they already picked up, then stop them"""
+    try:
+        await asyncio.wait_for(app.dispatcher.stop(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Update handlers did not finish in time")
+
+async def cancel_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+
+async def drain_jobs(timeout):
+    """Give running index/broadcast jobs until timeout, then hand them back to the queue"""
+    if running_jobs:
+        logger.info(f"⏳ Waiting for {len(running_jobs)} jobs")
+        await asyncio.wait(list(running_jobs.values()), timeout=timeout)
+    
+    unfinished = list(running_jobs)
+    tasks = list(running_jobs.values())
+    for task in tasks:
+        task.cancel()
+    # Cancelled broadcasts still flush their delivery results
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if unfinished:
+        # Both resume from their checkpoints on whichever replica claims them next
+        await jobs_collection.update_many(
+            {"_id": {"$in": unfinished}, "holder": REPLICA_ID},
+            {"$set": {"status": "pending"}, "$unset": {"holder": "", "lease_expires": ""}}
+        )
+        logger.info(f"↩️ Requeued {len(unfinished)} unfinished jobs")
+
+async def drain_deliveries(timeout):
+    try:
+        await asyncio.wait_for(delivery_queue.join(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Dropping {delivery_queue.qsize()} undelivered files")
+    for task in delivery_tasks:
+        task.cancel()
+
+async def hand_over_leadership():
+    """Run deletions that are already due and let another replica take over"""
+    global is_leader
+    
+    if is_leader:
+        for task in leader_tasks:
+            task.cancel()
+        leader_tasks.clear()
+        await auto_delete_job()
+        await release_lease("leader")
+        is_leader = False
+
+async def leave_replicas():
+    """Drop this replica's heartbeat so peers take over its users and chats right away"""
+    await release_lease(f"replica:{REPLICA_ID}")
+
+async def shutdown():
+    """Stop taking updates, drain background work, flush buffers and disconnect"""
+    global shutting_down
+    
+    shutting_down = True
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    remaining = lambda: max(0, deadline - time.monotonic())
+    logger.info("🛑 Shutting down...")
+    
+    # Heartbeats stop before the replica lease goes, or the next tick would renew it.
+    # Handlers stuck in a FloodWait sleep get at most a quarter of the budget.
+    steps = [
+        ("background loops", cancel_background_tasks),
+        ("replica lease", leave_replicas),
+        ("updates", lambda: stop_updates(remaining() * 0.25)),
+        ("jobs", lambda: drain_jobs(remaining() * 0.6)),
+        ("deliveries", lambda: drain_deliveries(remaining() * 0.5)),
+        ("leader lease", hand_over_leadership),
+        ("pending flushes", wait_for_flushes),
+        ("live index", flush_live_index),
+        ("search log", flush_search_log),
+        ("user registry", flush_user_writes),
+    ]
+    for name, step in steps:
+        try:
+            await step()
+        except Exception as e:
+            logger.error(f"Shutdown step {name} failed: {e}")
+    
+    scheduler.shutdown(wait=False)
+    await app.stop()
+    await web_runner.cleanup()
+    logger.info("👋 Shutdown complete")
+
 # ==================== MAIN ====================
 
 async def main():
-    # Start web server
+    global bot_ready
+    
+    # Start web server; /health reports not ready until warm-up is done
     await start_web_server()
     
-    # Start scheduler
-    scheduler.add_job(auto_delete_job, "interval", minutes=1)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    # Without change streams a ban or a new file would reach only one replica
+    if MULTI_REPLICA and not await change_streams_available():
+        raise RuntimeError("MULTI_REPLICA needs MongoDB change streams (a replica set); unset it to run a single replica")
+    
+    # Make sure the collections are indexed before anything queries them
+    await ensure_indexes()
+    
+    # Search index, ban list, channels and delete heap load concurrently.
+    # Joining the replica set also decides who runs the delete scheduler.
+    await warm_up()
+    logger.info(f"🧩 Replica {REPLICA_ID} of {len(live_replicas)} (leader: {is_leader})")
+    
+    for loop_coro in (watch_files(), watch_bans(), live_index_loop(), search_log_loop(), user_registry_loop(), replica_loop()):
+        background_tasks.append(asyncio.create_task(loop_coro))
+    if MULTI_REPLICA:
+        background_tasks.append(asyncio.create_task(watch_replicas()))
+    
+    # Start scheduler; popular queries are re-warmed every WARM_INTERVAL
+    scheduler.add_job(warm_popular_queries, "interval", seconds=WARM_INTERVAL)
     scheduler.start()
     
     # Start bot
     await app.start()
+    client_started.set()
     logger.info("🤖 Bot started successfully!")
+    await resume_broadcasts()
+    background_tasks.append(asyncio.create_task(job_worker_loop()))
+    start_delivery_workers()
+    bot_ready = True
     
-    # Keep running
-    await asyncio.Event().wait()
+    # Run until SIGTERM/SIGINT
+    await stop_event.wait()
+    await shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Pyrogram binds the client and its dispatcher to the loop that existed at import
+    app.run(main())